@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""
+Benchmark the image operations of wim and full proc_file runs on synthetic inputs.
+
+Each case runs in a fresh process, so the reported peak RSS belongs to that case only. Results are printed
+as a table and can be written as JSON and compared against a stored baseline, e.g.:
+
+    bin/benchmark.py --output baseline.json
+    bin/benchmark.py --baseline baseline.json
+
+Operations that can split an image into bands are run with each number of --threads and their speedup over
+a single thread is printed, e.g.:
+
+    bin/benchmark.py --sizes 12000x9000 --modes RGBA --ops set_background add_image --threads 1 2 4 8
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import PIL
+from PIL import Image, ImageOps
+
+from wim import cli, image
+from wim.__about__ import __version__
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None  # type: ignore
+
+MODES = ('RGB', 'RGBA', 'P')
+SAVE_FORMATS = ('jpeg', 'png', 'webp', 'gif')
+# Benchmark the save operation with the options of --quality only, or with each encoder effort preset.
+EFFORTS = ('none', *image.EFFORTS)
+# Operations that take the number of threads used for horizontal bands, see wim.image._run_bands.
+THREAD_OPS = ('add_text', 'add_image', 'set_background', 'proc_file')
+OPS = (
+    'decode',
+    'exif_transpose',
+    'trim',
+    'quantize',
+    'map_palette',
+    'thumbnail',
+    'add_text',
+    'add_image',
+    'set_background',
+    'save',
+    'proc_file',
+)
+# Formats used to store the input files for decode and proc_file cases.
+INPUT_FORMATS = {'RGB': 'jpeg', 'RGBA': 'png', 'P': 'gif'}
+THUMBNAIL_SIZE = (800, 800)
+PROC_FILE_ARGS = ['-s', '800', '800', '-t', 'wim benchmark', '--quality', '85']
+
+
+def make_image(size: tuple[int, int], mode: str) -> Image.Image:
+    """Create a synthetic image with noise and gradients, so it compresses like a photo."""
+
+    noise = Image.effect_noise(size, 40)
+    gradient = Image.linear_gradient('L').resize(size)
+    img = Image.merge('RGB', (noise, gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+
+    if mode == 'RGBA':
+        img.putalpha(Image.radial_gradient('L').resize(size))
+    elif mode == 'P':
+        img = img.quantize(256)
+    return img
+
+
+def encode(img: Image.Image, img_format: str) -> bytes:
+    if img_format == 'jpeg' and img.mode != 'RGB':
+        img = img.convert('RGB')
+    buf = io.BytesIO()
+    img.save(buf, img_format)
+    return buf.getvalue()
+
+
+def setup(op: str, img: Image.Image, img_format: str, workdir: Path, effort: str = 'none', threads: int = 1):
+    """Return a function that runs the operation once and a function that prepares its input."""
+
+    if op == 'decode':
+        data = encode(img, INPUT_FORMATS[img.mode])
+        return lambda _: Image.open(io.BytesIO(data)).load(), lambda: None
+
+    if op == 'exif_transpose':
+
+        def prepare():
+            copy = img.copy()
+            copy.getexif()[0x0112] = 6  # Rotated 90 degrees
+            return copy
+
+        return ImageOps.exif_transpose, prepare
+
+    if op == 'trim':
+        return ImageOps.crop, lambda: img
+
+    if op == 'quantize':
+        return lambda im: im.quantize(colors=64), lambda: img
+
+    if op == 'map_palette':
+        palette = image.build_palette([img], 64)
+        return lambda im: image.apply_palette(im, palette), lambda: img
+
+    if op == 'thumbnail':
+        return lambda im: im.thumbnail(THUMBNAIL_SIZE), img.copy
+
+    if op == 'add_text':
+        return lambda im: image.add_text(im, None, 16, 'wim benchmark', threads=threads), lambda: img
+
+    if op == 'add_image':
+        overlay = make_image((img.width // 8, img.height // 8), 'RGBA')
+        return lambda im: image.add_image(im, overlay, opacity=128, threads=threads), lambda: img
+
+    if op == 'set_background':
+        rgba = image.ensure_rgba(img)
+        return lambda im: image.set_background(im, threads), lambda: rgba
+
+    if op == 'save':
+        src = img.convert('RGB') if img_format not in image.RGBA_FORMATS and img.mode != 'RGB' else img
+        kwargs = image.get_quality(85, img_format)
+        if effort != 'none':
+            kwargs.update(image.get_effort(effort, img_format))
+        # Returns the encoded image, so its size is reported.
+        return lambda im: image.encode(im, img_format, effort, **kwargs), lambda: src
+
+    if op == 'proc_file':
+        suffix = INPUT_FORMATS[img.mode]
+        src = workdir / f'input.{suffix}'
+        src.write_bytes(encode(img, suffix))
+        argv = cli.get_args([str(src), *PROC_FILE_ARGS, '--threads', str(threads), '-o', str(workdir / 'out')])
+        return lambda _: cli.proc_file(str(src), argv), lambda: None
+
+    msg = f'Unknown operation: {op}'
+    raise ValueError(msg)
+
+
+def run_case(case: dict) -> dict:
+    """Run a single benchmark case and return its measurements."""
+
+    size = tuple(case['size'])
+    img = make_image(size, case['mode'])  # type: ignore
+
+    with tempfile.TemporaryDirectory() as tmp, redirect_stdout(io.StringIO()):
+        func, prepare = setup(case['op'], img, case['format'], Path(tmp), case['effort'], case['threads'])
+
+        # Warm up caches, e.g., fonts and overlays, so they don't count against the first timed run.
+        value = func(prepare())
+
+        wall, cpu = [], []
+        tracemalloc.start()
+        for _ in range(case['repeat']):
+            arg = prepare()
+            start, start_cpu = time.perf_counter(), time.process_time()
+            func(arg)
+            wall.append(time.perf_counter() - start)
+            cpu.append(time.process_time() - start_cpu)
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    median = statistics.median(wall)
+    max_rss = None
+    if resource:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+    return {
+        **case,
+        'wall_median': median,
+        'wall_min': min(wall),
+        'cpu_median': statistics.median(cpu),
+        'megapixels_per_second': size[0] * size[1] / 1e6 / median if median else None,
+        'bytes': len(value) if isinstance(value, bytes) else None,
+        'tracemalloc_peak': traced_peak,
+        'max_rss': max_rss,
+    }
+
+
+def get_cases(argv: argparse.Namespace) -> list[dict]:
+    cases = []
+    for size in argv.sizes:
+        for mode in argv.modes:
+            for op in argv.ops:
+                formats = argv.formats if op == 'save' else [INPUT_FORMATS[mode]]
+                efforts = argv.efforts if op == 'save' else ['none']
+                threads = argv.threads if op in THREAD_OPS else [1]
+                cases.extend(
+                    {
+                        'op': op,
+                        'size': size,
+                        'mode': mode,
+                        'format': img_format,
+                        'effort': effort,
+                        'threads': count,
+                        'repeat': argv.repeat,
+                    }
+                    for img_format in formats
+                    for effort in efforts
+                    for count in threads
+                )
+    return cases
+
+
+def case_id(case: dict) -> str:
+    width, height = case['size']
+    key = f'{case["op"]}/{width}x{height}/{case["mode"]}/{case["format"]}'
+    if case.get('effort', 'none') != 'none':
+        key = f'{key}/{case["effort"]}'
+    return key if case.get('threads', 1) == 1 else f'{key}/{case["threads"]}t'
+
+
+def print_speedup(results: dict) -> None:
+    """Print the speedup of cases run with several threads over the same case with a single thread."""
+
+    print(f'\n{"case":<40} {"threads":>7} {"speedup":>8}')
+    for key, result in results.items():
+        single = results.get(case_id({**result, 'threads': 1}))
+        if result.get('threads', 1) > 1 and single:
+            print(f'{key:<40} {result["threads"]:>7} {single["wall_median"] / result["wall_median"]:>7.2f}x')
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Print the ratio of current to baseline wall time per case and return ids of regressed cases."""
+
+    regressions = []
+    print(f'\n{"case":<40} {"baseline":>10} {"current":>10} {"ratio":>7}')
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        before, after = baseline[key]['wall_median'], result['wall_median']
+        ratio = after / before if before else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(key)
+            flag = ' slower'
+        print(f'{key:<40} {before * 1000:>8.2f}ms {after * 1000:>8.2f}ms {ratio:>7.2f}{flag}')
+    return regressions
+
+
+def parse_size(value: str) -> tuple[int, int]:
+    width, _, height = value.lower().partition('x')
+    return int(width), int(height)
+
+
+def get_args(args=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark wim image operations.')
+    parser.add_argument(
+        '--sizes', type=parse_size, nargs='+', default=[(640, 480), (1920, 1080)], help='Image sizes as WxH.'
+    )
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES), help='Image modes.')
+    parser.add_argument('--formats', nargs='+', choices=SAVE_FORMATS, default=list(SAVE_FORMATS), help='Save formats.')
+    parser.add_argument(
+        '--efforts', nargs='+', choices=EFFORTS, default=['none'], help='Encoder effort presets for save cases.'
+    )
+    parser.add_argument('--ops', nargs='+', choices=OPS, default=list(OPS), help='Operations to benchmark.')
+    parser.add_argument(
+        '--threads', type=int, nargs='+', default=[1], help=f'Numbers of threads for {", ".join(THREAD_OPS)}.'
+    )
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case (default: 5).')
+    parser.add_argument('--output', help='Write results as JSON to this file.')
+    parser.add_argument('--baseline', help='Compare results with a JSON file written by --output.')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.1, help='Allowed slowdown relative to baseline (default: 0.1).'
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None) -> None:
+    argv = get_args(args)
+    results = {}
+
+    # A fresh process per case isolates caches and peak memory.
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for result in pool.imap(run_case, get_cases(argv)):
+            key = case_id(result)
+            results[key] = result
+            rss = f'{result["max_rss"] / 2**20:.1f}MB' if result['max_rss'] else 'n/a'
+            size = f'{result["bytes"] / 1024:.0f}KB' if result['bytes'] else ''
+            print(
+                f'{key:<40} {result["wall_median"] * 1000:>10.2f}ms {result["megapixels_per_second"]:>8.1f}MP/s '
+                f'{rss:>9} {size:>8}'
+            )
+
+    if len(argv.threads) > 1:
+        print_speedup(results)
+
+    report = {
+        'wim': __version__,
+        'pillow': PIL.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if argv.output:
+        Path(argv.output).write_text(json.dumps(report, indent=2))
+
+    if argv.baseline:
+        baseline = json.loads(Path(argv.baseline).read_text())
+        if compare(results, baseline['results'], argv.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import time
+
+from wim import batch
+
+
+def test_pipeline_keeps_order_and_collects_errors():
+    written = []
+
+    def read(name):
+        if name == 'unreadable':
+            msg = 'cannot read'
+            raise OSError(msg)
+        # Later files are read faster, so reads complete out of order.
+        time.sleep(0.01 * len(name))
+        return name.upper()
+
+    def process(name, data):
+        print(f'processing {name}')
+        if name == 'bad':
+            msg = 'cannot process'
+            raise ValueError(msg)
+        return data
+
+    def write(task):
+        if task == 'READONLY':
+            msg = 'cannot write'
+            raise PermissionError(msg)
+        written.append(task)
+        return task.lower()
+
+    names = ['first', 'unreadable', 'bad', 'readonly', 'b', 'last']
+    results = list(batch.pipeline(names, read, process, write, prefetch=2))
+
+    assert [name for name, _, _, _ in results] == names
+    assert [value for _, value, _, _ in results] == ['first', None, None, None, 'b', 'last']
+    errors = {name: error for name, _, _, error in results if error}
+    assert errors == {
+        'unreadable': 'OSError: cannot read',
+        'bad': 'ValueError: cannot process',
+        'readonly': 'PermissionError: cannot write',
+    }
+    assert results[0][2] == 'processing first\n'
+    assert sorted(written) == ['B', 'FIRST', 'LAST']
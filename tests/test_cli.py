@@ -0,0 +1,273 @@
+import io
+import json
+
+import pytest
+from PIL import Image
+
+from wim import cli, image
+
+
+def make_images(tmp_path, count=3, size=(60, 40)):
+    names = []
+    for i in range(count):
+        path = tmp_path / f'img{i}.png'
+        Image.new('RGB', size, (i * 40, 0, 0)).save(path)
+        names.append(str(path))
+    return names
+
+
+def test_proc_file_does_not_mutate_argv(tmp_path):
+    names = make_images(tmp_path, count=1)
+    argv = cli.get_args([*names, '-o', str(tmp_path / 'out')])
+    (dst,) = cli.proc_file(names[0], argv)
+    assert dst.suffix == '.png'
+    assert argv.format is None
+
+
+def test_pipeline_is_created_once_per_file(tmp_path, monkeypatch):
+    (name,) = make_images(tmp_path, count=1, size=(300, 200))
+    args = [name, '-s', '200', '200', '-s', '100', '100', '-t', 'wim', '--format', 'png,webp']
+    argv = cli.get_args([*args, '-o', str(tmp_path / 'out')])
+    calls = []
+    get_pipeline = cli.get_pipeline
+    monkeypatch.setattr(cli, 'get_pipeline', lambda argv: calls.append(argv) or get_pipeline(argv))
+
+    assert len(cli.proc_file(name, argv)) == 4
+    assert len(calls) == 1
+
+
+def test_proc_image_does_not_modify_input():
+    img = Image.new('RGB', (100, 75), (0, 0, 255))
+    argv = cli.get_args(['img.png', '-s', '50', '50', '-t', 'wim'])
+    out, _ = cli.proc_image(img, argv, cli.get_pipeline(argv))
+    assert out.size == (50, 38)
+    assert img.size == (100, 75)
+    assert img.getcolors() == [(100 * 75, (0, 0, 255))]
+
+
+def test_main_parallel_collects_errors(tmp_path, capsys):
+    names = make_images(tmp_path)
+    bad = tmp_path / 'bad.png'
+    bad.write_text('not an image')
+    outdir = tmp_path / 'out'
+
+    with pytest.raises(SystemExit) as exc:
+        cli.main([names[0], str(bad), *names[1:], '-j', '2', '-o', str(outdir)])
+    assert exc.value.code == 1
+
+    captured = capsys.readouterr()
+    # Output follows input order and failures don't stop the batch.
+    saved = [line for line in captured.out.splitlines() if line.startswith('Save image as')]
+    assert saved == [f'Save image as: {outdir / f"img{i}-wim.png"}' for i in range(3)]
+    assert 'bad.png' in captured.err
+    assert 'Processed 4 files: 3 succeeded, 0 skipped, 1 failed.' in captured.out
+
+
+def test_main_incremental_skips_unchanged(tmp_path, capsys):
+    names = make_images(tmp_path, count=2)
+    args = [*names, '-j', '1', '-o', str(tmp_path / 'out'), '--incremental', '--manifest', str(tmp_path / 'm.json')]
+
+    cli.main(args)
+    assert '2 succeeded, 0 skipped' in capsys.readouterr().out
+
+    cli.main(args)
+    assert '0 succeeded, 2 skipped' in capsys.readouterr().out
+
+    # Changed options invalidate all outputs.
+    cli.main([*args, '--quality', '80'])
+    assert '2 succeeded, 0 skipped' in capsys.readouterr().out
+
+    # Changed sources are processed again.
+    Image.new('RGB', (10, 10)).save(names[0])
+    cli.main([*args, '--quality', '80'])
+    assert '1 succeeded, 1 skipped' in capsys.readouterr().out
+
+
+def test_main_multiple_sizes(tmp_path):
+    names = make_images(tmp_path, count=1, size=(400, 200))
+    outdir = tmp_path / 'out'
+    cli.main(
+        [*names, '-s', '100', '100', '-s', '300', '300', '-s', '200', '200', '-o', str(outdir), '--srcset', 'json']
+    )
+
+    for width, height in [(300, 150), (200, 100), (100, 50)]:
+        with Image.open(outdir / f'img0-wim-{width}w.png') as img:
+            assert img.size == (width, height)
+
+    srcset = json.loads((outdir / 'img0-wim-srcset.json').read_text())
+    assert srcset['srcset'] == 'img0-wim-300w.png 300w, img0-wim-200w.png 200w, img0-wim-100w.png 100w'
+
+
+def test_sizes_are_ordered_by_output_size(tmp_path):
+    names = make_images(tmp_path, count=1, size=(2000, 2000))
+    outdir = tmp_path / 'out'
+    cli.main([*names, '-s', '1000', '100', '-s', '300', '300', '-o', str(outdir)])
+
+    assert sorted(path.name for path in outdir.iterdir()) == ['img0-wim-100w.png', 'img0-wim-300w.png']
+    assert cli.sort_sizes((2000, 2000), [(1000, 100), (300, 300)]) == [(300, 300), (1000, 100)]
+
+
+def test_main_multiple_formats(tmp_path):
+    path = tmp_path / 'alpha.png'
+    Image.new('RGBA', (40, 30), (255, 0, 0, 128)).save(path)
+    outdir = tmp_path / 'out'
+    cli.main([str(path), '--format', 'webp,jpeg,png', '--quantize', '16', '-o', str(outdir)])
+
+    modes = {}
+    for suffix in ('webp', 'jpeg', 'png'):
+        with Image.open(outdir / f'alpha-wim.{suffix}') as img:
+            modes[suffix] = img.mode
+    assert modes == {'webp': 'RGBA', 'jpeg': 'RGB', 'png': 'P'}
+
+
+def test_quantized_output_does_not_depend_on_other_formats(tmp_path):
+    (name,) = make_images(tmp_path, count=1, size=(300, 200))
+    args = [name, '--quantize', '16', '-t', 'hello', '-s', '200', '200']
+    cli.main([*args, '--format', 'png', '-o', str(tmp_path / 'single')])
+    cli.main([*args, '--format', 'png,webp', '-o', str(tmp_path / 'multi')])
+
+    with Image.open(tmp_path / 'single/img0-wim.png') as single, Image.open(tmp_path / 'multi/img0-wim.png') as multi:
+        assert single.mode == multi.mode == 'P'
+        assert single.tobytes() == multi.tobytes()
+
+
+def test_max_bytes_lowers_quantize_colors(tmp_path):
+    path = tmp_path / 'noise.png'
+    Image.effect_noise((200, 150), 60).convert('RGB').save(path)
+    args = [str(path), '--quantize', '8', '--format', 'png,webp']
+    cli.main([*args, '-o', str(tmp_path / 'full')])
+    limit = (tmp_path / 'full/noise-wim.png').stat().st_size // 2
+
+    cli.main([*args, '--max-bytes', str(limit), '-o', str(tmp_path / 'small')])
+    assert (tmp_path / 'small/noise-wim.png').stat().st_size <= limit
+    with Image.open(tmp_path / 'small/noise-wim.png') as img:
+        assert img.mode == 'P'
+
+
+def test_get_args_rejects_invalid_format():
+    with pytest.raises(SystemExit):
+        cli.get_args(['a.png', '--format', 'webp,tiff'])
+
+
+@pytest.mark.parametrize('option', [['--quality', '0'], ['--quantize', '300'], ['--watermark-opacity', '256']])
+def test_get_args_rejects_values_out_of_range(option, capsys):
+    with pytest.raises(SystemExit):
+        cli.get_args(['a.png', *option])
+    assert f'{option[0]} must be between' in capsys.readouterr().err
+
+
+def test_proc_stream_infers_format_from_content(tmp_path):
+    path = tmp_path / 'image.data'
+    Image.new('RGB', (60, 40), (0, 0, 255)).save(path, 'webp')
+    argv = cli.get_args([str(path), '--stdout', '-s', '30', '30'])
+
+    out = io.BytesIO()
+    cli.proc_stream(str(path), argv, out)
+    out.seek(0)
+    with Image.open(out) as img:
+        assert img.format == 'WEBP'
+        assert img.size == (30, 20)
+
+
+def test_proc_stream_warns_if_max_bytes_is_not_reached(tmp_path, capsys):
+    path = tmp_path / 'noise.png'
+    Image.effect_noise((200, 200), 64).save(path)
+    argv = cli.get_args([str(path), '--stdout', '--format', 'webp', '--max-bytes', '200'])
+
+    out = io.BytesIO()
+    cli.proc_stream(str(path), argv, out)
+    assert len(out.getvalue()) > 200
+    assert f'output is {len(out.getvalue())} bytes, larger than 200' in capsys.readouterr().err
+
+
+def test_get_args_stdin_requires_stdout():
+    with pytest.raises(SystemExit):
+        cli.get_args(['-'])
+    assert cli.get_args(['-', '--stdout']).filename == ['-']
+
+
+def test_memory_limit_and_max_pixels(tmp_path, monkeypatch):
+    (name,) = make_images(tmp_path, count=1, size=(400, 300))
+    outdir = str(tmp_path / 'out')
+
+    argv = cli.get_args([name, '-t', 'wim', '--format', 'png'])
+    # The decoded frame and an RGBA copy for the text
+    assert cli.estimate_memory(Image.open(name), argv) == 400 * 300 * 4 * 2
+
+    name = str(tmp_path / 'large.jpg')
+    Image.new('RGB', (1000, 1000)).save(name)
+    with pytest.raises(MemoryError, match='--memory-limit 1MB'):
+        cli.proc_file(name, cli.get_args([name, '-t', 'wim', '-o', outdir, '--memory-limit', '1']))
+    # A reduced-size decode fits into the budget.
+    cli.proc_file(name, cli.get_args([name, '-s', '100', '100', '-o', outdir, '--memory-limit', '1']))
+
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', Image.MAX_IMAGE_PIXELS)
+    with pytest.raises(Image.DecompressionBombError):
+        cli.proc_file(name, cli.get_args([name, '-o', outdir, '--max-pixels', '1000']))
+
+
+def test_main_keeps_animation(tmp_path):
+    src = tmp_path / 'anim.gif'
+    frames = [Image.new('RGB', (80, 60), (i * 50, 100, 200 - i * 50)) for i in range(4)]
+    frames[0].save(src, save_all=True, append_images=frames[1:], duration=[100, 120, 140, 160], loop=2, disposal=2)
+    outdir = tmp_path / 'out'
+
+    cli.main([str(src), '-o', str(outdir), '--format', 'gif,webp', '-s', '40', '40', '-t', 'hi', '--quantize', '16'])
+
+    for name in ('anim-wim.gif', 'anim-wim.webp'):
+        with Image.open(outdir / name) as img:
+            assert img.size == (40, 30)
+            assert img.n_frames == 4
+            assert img.info['loop'] == 2
+            durations = []
+            for frame in range(img.n_frames):
+                img.seek(frame)
+                img.load()
+                durations.append(img.info['duration'])
+            assert durations == [100, 120, 140, 160]
+            if name.endswith('.gif'):
+                assert img.disposal_method == 2
+
+
+def test_palette_sample_shares_palette(tmp_path, capsys):
+    names = []
+    for i in range(3):
+        path = tmp_path / f'img{i}.png'
+        Image.effect_noise((60, 40), 30 + i * 20).convert('RGB').save(path)
+        names.append(str(path))
+    outdir = tmp_path / 'out'
+
+    cli.main([*names, '-o', str(outdir), '--quantize', '32', '--palette-sample', '2', '-j', '2'])
+    palettes = set()
+    for i in range(3):
+        with Image.open(outdir / f'img{i}-wim.png') as img:
+            assert img.mode == 'P'
+            palettes.add(bytes(img.getpalette()))
+    assert len(palettes) == 1
+
+    with pytest.raises(SystemExit):
+        cli.get_args([names[0], '--palette-sample', '2'])
+    assert '--quantize' in capsys.readouterr().err
+
+
+def test_palette_sample_without_readable_files(tmp_path):
+    path = tmp_path / 'broken.png'
+    path.write_bytes(b'not an image')
+
+    with pytest.raises(SystemExit, match='no images to build a palette from'):
+        cli.main([str(path), '-o', str(tmp_path / 'out'), '--quantize', '16', '--palette-sample', '1'])
+
+
+def test_pipeline_matches_main(tmp_path):
+    path = tmp_path / 'photo.jpg'
+    Image.radial_gradient('L').convert('RGB').resize((300, 200)).save(path, quality=95)
+    mark = tmp_path / 'mark.png'
+    Image.new('RGBA', (40, 20), (255, 255, 0, 200)).save(mark)
+    outdir = tmp_path / 'out'
+    args = ['-s', '120', '120', '-t', 'Hi', '-w', str(mark), '--watermark-opacity', '128', '--quality', '70']
+    cli.main([str(path), *args, '--format', 'webp', '-o', str(outdir)])
+
+    pipeline = image.Pipeline(
+        'webp', scale=(120, 120), text='Hi', watermark=str(mark), watermark_opacity=128, quality=70
+    )
+    assert pipeline.process_bytes(path.read_bytes()) == (outdir / 'photo-wim.webp').read_bytes()
@@ -0,0 +1,82 @@
+import io
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+from wim import cli, discover
+
+
+def make_tree(tmp_path):
+    for path in ['a.jpg', 'b.txt', 'a-wim.jpg', 'a-wim-400w.webp', 'sub/c.PNG', 'sub/skip/d.gif', 'sub/e.jpeg']:
+        file = tmp_path / path
+        file.parent.mkdir(parents=True, exist_ok=True)
+        if file.suffix == '.txt':
+            file.write_text('not an image')
+        else:
+            Image.new('RGB', (20, 10)).save(file)
+    return tmp_path
+
+
+def test_scan_filters_and_skips_outputs(tmp_path):
+    root = make_tree(tmp_path)
+    found = list(discover.scan(str(root), output_label='-wim'))
+    assert found == [str(root / name) for name in ['a.jpg', 'sub/c.PNG', 'sub/e.jpeg', 'sub/skip/d.gif']]
+
+    found = list(discover.scan(str(root), include=['sub/*'], exclude=['*/skip/*', 'e.*'], output_label='-wim'))
+    assert found == [str(root / 'sub/c.PNG')]
+
+
+def test_read_names_skips_empty_lines(tmp_path):
+    names = tmp_path / 'names.txt'
+    names.write_text('a.jpg\n\nwith space.png\r\n')
+    assert list(discover.read_names(str(names))) == ['a.jpg', 'with space.png']
+
+
+def test_read_names_keeps_undecodable_names(tmp_path, monkeypatch):
+    data = b'caf\xe9.jpg\nok.png\n'
+    expected = [os.fsdecode(b'caf\xe9.jpg'), 'ok.png']
+    names = tmp_path / 'names.txt'
+    names.write_bytes(data)
+    assert list(discover.read_names(str(names))) == expected
+
+    monkeypatch.setattr(sys, 'stdin', io.TextIOWrapper(io.BytesIO(data)))
+    assert list(discover.read_names('-')) == expected
+
+
+def test_main_recursive_and_files_from(tmp_path, capsys):
+    root = make_tree(tmp_path / 'src')
+    names = tmp_path / 'names.txt'
+    names.write_text(f'{root / "a.jpg"}\n{root / "b.txt"}\n')
+
+    cli.main(['--recursive', str(root / 'sub'), '--files-from', str(names), '-j', '1'])
+    out = capsys.readouterr().out
+    assert 'Processed 4 files: 4 succeeded, 0 skipped, 0 failed.' in out
+    assert (root / 'sub/skip/d-wim.gif').exists()
+
+    # Outputs written by the first run are not picked up as inputs.
+    cli.main(['--recursive', str(root), '-j', '2'])
+    assert 'Processed 4 files: 4 succeeded' in capsys.readouterr().out
+
+
+def test_scan_reports_unreadable_directories(tmp_path, monkeypatch):
+    root = make_tree(tmp_path)
+    scandir = discover.os.scandir
+
+    def fail_on_sub(path):
+        if path.endswith('sub'):
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+
+    monkeypatch.setattr(discover.os, 'scandir', fail_on_sub)
+    errors = []
+    assert list(discover.scan(str(root), errors.append, output_label='-wim')) == [str(root / 'a.jpg')]
+    assert [error.filename for error in errors] == [str(root / 'sub')]
+
+
+def test_get_args_rejects_missing_inputs(tmp_path):
+    with pytest.raises(SystemExit):
+        cli.get_args(['--recursive', str(tmp_path / 'missing')])
+    with pytest.raises(SystemExit):
+        cli.get_args(['--files-from', str(tmp_path / 'missing.txt')])
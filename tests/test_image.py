@@ -1,8 +1,18 @@
-from PIL import Image, ImageDraw, ImageFont
+import io
+
+import pytest
+from PIL import Image, ImageCms, ImageDraw, ImageFont
 
 from wim import image
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    # Fonts are monkeypatched in some tests, so don't share cached fonts and text between tests.
+    image.load_font.cache_clear()
+    image.render_text.cache_clear()
+
+
 class _FakeFont:
     """Wrap a PIL ImageFont and provide getbbox/getsize/getmask expected by wim.image.add_text."""
 
@@ -115,3 +125,251 @@ def test_set_background_uses_black_and_preserves_opaque_pixels():
     assert rgb.getpixel((0, 0)) == (255, 255, 255)
     # Transparent pixels should become black
     assert rgb.getpixel((1, 1)) == (0, 0, 0)
+
+
+def test_prepare_overlay_is_cached_and_accepted_by_add_image(tmp_path):
+    overlay_path = tmp_path / "overlay.png"
+    Image.new('RGBA', (20, 20), (0, 0, 255, 255)).save(overlay_path)
+
+    prepared = image.prepare_overlay(str(overlay_path), scale=[10, 10], opacity=128)
+    assert prepared is image.prepare_overlay(str(overlay_path), scale=(10, 10), opacity=128)
+    assert prepared.size == (10, 10)
+    assert prepared.getpixel((0, 0))[3] == 128
+
+    base = Image.new('RGBA', (50, 50), (255, 255, 255, 255))
+    from_path = image.add_image(base, str(overlay_path), scale=(10, 10), opacity=128)
+    from_prepared = image.add_image(base, prepared)
+    assert from_path.tobytes() == from_prepared.tobytes()
+
+
+def test_render_text_is_cached_and_font_loaded_once(capsys):
+    tile = image.render_text(None, 12, 'hello')
+    assert tile is image.render_text(None, 12, 'hello')
+    assert tile.image.mode == 'RGBA'
+
+    base = Image.new('RGB', (80, 30), (255, 255, 255))
+    image.add_text(base, None, 12, 'hello')
+    image.add_text(base, None, 12, 'other')
+    assert capsys.readouterr().out.count('Using system default font.') == 1
+
+
+def test_add_image_matches_full_canvas_composite():
+    base = Image.new('RGBA', (40, 30), (10, 200, 30, 200))
+    original = base.tobytes()
+    overlay = Image.new('RGBA', (50, 10), (255, 0, 0, 128))
+
+    # The overlay is wider than the base image, so it is clipped at both sides.
+    result = image.add_image(base, overlay, position='center')
+
+    canvas = Image.new('RGBA', base.size, (0, 0, 0, 0))
+    canvas.paste(overlay, image.calculate_position(base.size, overlay.size, 'center', 0), overlay)
+    assert result.tobytes() == Image.alpha_composite(base, canvas).tobytes()
+    assert base.tobytes() == original
+
+
+def test_draft_uses_transposed_size(tmp_path):
+    path = tmp_path / 'rotated.jpg'
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotated 90 degrees, transposed size is 200x600.
+    Image.new('RGB', (600, 200), (0, 0, 255)).save(path, exif=exif)
+
+    with Image.open(path) as img:
+        image.draft(img, (50, 150))
+        assert img.size == (300, 100)
+
+    with Image.open(tmp_path / 'rotated.jpg') as img:
+        img.load()
+        image.draft(img, (50, 150))
+        assert img.size == (600, 200)
+
+
+def test_encode_max_bytes_searches_quality_and_colors():
+    img = Image.effect_noise((200, 150), 60).convert('RGB')
+
+    lossless = len(image.encode(img, 'jpg', quality=95))
+    data = image.encode_max_bytes(img, 'jpg', lossless // 2)
+    assert len(data) <= lossless // 2
+    assert Image.open(io.BytesIO(data)).format == 'JPEG'
+
+    png = len(image.encode(img, 'png'))
+    data = image.encode_max_bytes(img, 'png', png // 2)
+    assert len(data) <= png // 2
+    assert Image.open(io.BytesIO(data)).mode == 'P'
+
+
+def test_max_bytes_searches_colors_up_to_quantize():
+    img = Image.effect_noise((200, 150), 60).convert('RGB')
+    buf = io.BytesIO()
+    img.save(buf, 'png')
+    quantized = len(image.Pipeline('png', quantize=8).process_bytes(buf.getvalue()))
+
+    data = image.Pipeline('png', quantize=8, max_bytes=quantized // 2).process_bytes(buf.getvalue())
+    assert len(data) <= quantized // 2
+    with Image.open(io.BytesIO(data)) as out:
+        assert out.mode == 'P'
+        assert len(out.getcolors()) < 8
+
+    data = image.encode_max_bytes(img, 'png', quantized * 10, colors=8)
+    with Image.open(io.BytesIO(data)) as out:
+        assert out.mode == 'P'
+        assert len(out.getcolors()) == 8
+
+
+def test_encode_max_effort_keeps_smallest_png_strategy():
+    img = Image.effect_noise((120, 80), 30).convert('RGB')
+    kwargs = image.get_effort('max', 'png')
+    assert kwargs == {'optimize': True, 'compress_level': 9}
+    assert image.get_effort('fast', 'jpg') == {'optimize': False, 'progressive': False}
+    assert image.get_effort('max', 'bmp') == {}
+
+    data = image.encode(img, 'png', 'max', **kwargs)
+    sizes = [len(image.encode(img, 'png', **{**kwargs, **variant})) for variant in image.PNG_VARIANTS]
+    assert len(data) == min(sizes)
+    assert Image.open(io.BytesIO(data)).tobytes() == img.tobytes()
+
+
+def test_keep_rgb_matches_set_background():
+    base = Image.effect_noise((120, 90), 60).convert('RGB')
+    overlay = Image.effect_noise((50, 40), 80).convert('RGB')
+    overlay.putalpha(Image.linear_gradient('L').resize(overlay.size))
+
+    expected = image.set_background(image.add_text(base, None, 16, 'wim', position='center'))
+    result = image.add_text(base, None, 16, 'wim', position='center', keep_rgb=True)
+    assert result.mode == 'RGB'
+    assert result.tobytes() == expected.tobytes()
+
+    expected = image.set_background(image.add_image(base, overlay, padding=-10, opacity=128))
+    result = image.add_image(base, overlay, padding=-10, opacity=128, keep_rgb=True)
+    assert result.mode == 'RGB'
+    assert result.tobytes() == expected.tobytes()
+
+    # A transparent color must be blended as transparent.
+    base.info['transparency'] = (0, 0, 0)
+    assert image.add_image(base, overlay, keep_rgb=True).mode == 'RGBA'
+
+
+def test_thumbnail_size_matches_pillow():
+    for size, max_size in [
+        ((1200, 900), (500, 500)),
+        ((333, 1000), (100, 400)),
+        ((50, 40), (100, 100)),
+        ((999, 1), (10, 10)),
+    ]:
+        img = Image.new('L', size)
+        img.thumbnail(max_size)
+        assert image.thumbnail_size(size, max_size) == img.size
+
+
+def test_threads_match_single_thread():
+    # Taller than two bands, the overlay starts and ends inside bands.
+    height = image.BAND_HEIGHT * 2 + 50
+    base = Image.effect_noise((120, height), 60).convert('RGB')
+    base.putalpha(Image.linear_gradient('L').resize(base.size))
+    overlay = Image.effect_noise((100, height - 40), 80).convert('RGB')
+    overlay.putalpha(Image.linear_gradient('L').resize(overlay.size))
+
+    for img in (base, base.convert('RGB')):
+        keep_rgb = img.mode == 'RGB'
+        expected = image.add_image(img, overlay, position='center', opacity=100, keep_rgb=keep_rgb)
+        result = image.add_image(img, overlay, position='center', opacity=100, keep_rgb=keep_rgb, threads=3)
+        assert result.tobytes() == expected.tobytes()
+
+        expected = image.add_text(img, None, 16, 'wim', keep_rgb=keep_rgb)
+        assert image.add_text(img, None, 16, 'wim', keep_rgb=keep_rgb, threads=3).tobytes() == expected.tobytes()
+
+    assert image.set_background(base, threads=3).tobytes() == image.set_background(base).tobytes()
+
+
+def test_shared_palette_keeps_transparency():
+    opaque = Image.effect_noise((64, 48), 60).convert('RGB')
+    transparent = Image.new('RGBA', (40, 40), (255, 0, 0, 255))
+    transparent.paste((0, 0, 0, 0), (0, 0, 20, 40))
+
+    palette = image.build_palette([opaque, transparent], colors=16)
+    assert len(palette.getpalette()) == 16 * 3
+    assert palette.info['transparency'] == 15
+
+    result = image.quantize(transparent, palette=palette)
+    assert result.getpalette() == palette.getpalette()
+    assert result.info['transparency'] == 15
+    assert result.getpixel((0, 0)) == 15
+    # Opaque pixels never get the transparent entry, even black ones.
+    assert 15 not in image.apply_palette(Image.new('RGB', (8, 8)), palette).tobytes()
+
+
+def test_load_palette_moves_transparent_entry_last(tmp_path):
+    path = tmp_path / 'palette.png'
+    img = Image.new('P', (4, 1))
+    img.putpalette([0, 0, 0, 255, 0, 0, 0, 255, 0, 0, 0, 255])
+    img.save(path, transparency=1)
+
+    palette = image.load_palette(str(path))
+    assert palette.getpalette() == [0, 0, 0, 0, 255, 0, 0, 0, 255, 0, 0, 0]
+    assert palette.info['transparency'] == 3
+    assert image.load_palette(str(path)) is palette
+
+
+def test_pipeline_does_not_modify_input_and_keeps_order():
+    pipeline = image.Pipeline('png', scale=(20, 20), text='x', quantize=8)
+    images = [Image.new('RGBA', (40 + i, 40), (i * 20, 0, 0, 128)) for i in range(5)]
+    before = [img.tobytes() for img in images]
+
+    results = list(pipeline.process_many(images, jobs=2))
+    assert [img.tobytes() for img in images] == before
+    assert [img.size for img in results] == [pipeline.process(img).size for img in images]
+    assert [img.size[0] for img in results] == [20, 20, 20, 20, 20]
+
+    data = [io.BytesIO() for _ in range(3)]
+    for i, buf in enumerate(data):
+        Image.new('RGB', (10 * (i + 1), 10)).save(buf, 'bmp')
+    outputs = list(pipeline.process_many(buf.getvalue() for buf in data))
+    assert [Image.open(io.BytesIO(out)).size for out in outputs] == [(10, 10), (20, 10), (20, 7)]
+
+
+def test_pipeline_prepares_watermark_with_threads(tmp_path, monkeypatch):
+    path = tmp_path / 'mark.png'
+    Image.new('RGBA', (20, 10)).save(path)
+    calls = []
+    prepare = image.prepare_overlay
+
+    def record(*args, **kwargs):
+        calls.append(kwargs['threads'])
+        return prepare(*args, **kwargs)
+
+    monkeypatch.setattr(image, 'prepare_overlay', record)
+    image.Pipeline(watermark=str(path), watermark_opacity=128, threads=4)
+    assert calls == [4]
+
+
+def test_pipeline_keeps_metadata_of_animations():
+    exif = Image.Exif()
+    exif[0x010E] = 'animated'
+    icc = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+    frames = [Image.new('RGB', (40, 30), color) for color in ('red', 'blue')]
+    buf = io.BytesIO()
+    frames[0].save(buf, 'webp', save_all=True, append_images=frames[1:], exif=exif, icc_profile=icc)
+
+    out = Image.open(io.BytesIO(image.Pipeline(scale=(20, 20)).process_bytes(buf.getvalue())))
+    assert out.n_frames == 2
+    assert out.size == (20, 15)
+    assert out.getexif()[0x010E] == 'animated'
+    assert out.info['icc_profile'] == icc
+
+
+@pytest.mark.parametrize(
+    ('options', 'match'),
+    [
+        ({'img_format': 'tiff'}, 'invalid format'),
+        ({'quality': 0}, 'quality must be between'),
+        ({'quantize': 300}, 'quantize must be between'),
+        ({'effort': 'slow'}, 'invalid effort'),
+        ({'watermark_position': 'top'}, 'invalid watermark position'),
+        ({'font_size': 12}, 'font_size requires font'),
+        ({'quantize_method': 'fastoctree'}, 'require quantize'),
+        ({'quantize': 8, 'dither': 'ordered'}, 'invalid dither'),
+        ({'threads': 0}, 'threads must be at least 1'),
+    ],
+)
+def test_pipeline_rejects_invalid_options(options, match):
+    with pytest.raises(ValueError, match=match):
+        image.Pipeline(**options)
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+from PIL import Image
+
+from wim import cli, plan
+
+
+def test_plan_file_matches_processing(tmp_path):
+    src = tmp_path / 'photo.jpg'
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    Image.new('RGB', (1200, 900)).save(src, exif=exif)
+    outdir = tmp_path / 'out'
+    argv = cli.get_args([str(src), '-s', '500', '500', '-t', 'wim', '--quantize', '16', '-o', str(outdir)])
+
+    result = plan.plan_file(str(src), argv)
+    assert not outdir.exists()
+    assert result['size'] == (1200, 900)
+    assert result['steps'] == [
+        'decode',
+        'exif_transpose',
+        'quantize skipped for jpg',
+        'thumbnail',
+        'add_text',
+        'save jpeg',
+    ]
+
+    ((path, size),) = result['outputs']
+    (dst,) = cli.proc_file(str(src), argv)
+    assert path == str(dst)
+    assert size == Image.open(dst).size
+
+
+def test_main_dry_run_with_calibration(tmp_path, capsys):
+    names = []
+    for i in range(3):
+        names.append(str(tmp_path / f'img{i}.png'))
+        Image.new('RGBA', (200, 100)).save(names[-1])
+    names.append(str(tmp_path / 'bad.png'))
+    (tmp_path / 'bad.png').write_text('not an image')
+    calibration = tmp_path / 'calibration.json'
+    calibration.write_text(
+        json.dumps({'results': {'save/x': {'op': 'save', 'format': 'jpeg', 'megapixels_per_second': 0.1}}})
+    )
+
+    cli.main([*names, '--format', 'jpg', '--dry-run', '--calibration', str(calibration), '-j', '1'])
+    out = capsys.readouterr().out
+    assert 'steps: decode, set_background, save jpeg; memory' in out
+    assert 'Dry run: 4 files, 1 unreadable, 0.1 megapixels decoded, 0.1 megapixels written' in out
+    # Saving dominates with the calibrated throughput.
+    assert '~0.6s' in out
+    assert not list(tmp_path.glob('*-wim.*'))
+
+
+def test_dry_run_writes_nothing(tmp_path, capsys):
+    name = str(tmp_path / 'img.png')
+    Image.new('RGB', (60, 40)).save(name)
+    outdir = tmp_path / 'out'
+
+    cli.main([name, '--dry-run', '--incremental', '--manifest', str(tmp_path / 'm.json'), '-o', str(outdir)])
+    assert 'Dry run: 1 files' in capsys.readouterr().out
+    assert not outdir.exists()
+    with pytest.raises(SystemExit):
+        cli.get_args([name, '--dry-run', '--stdout'])
@@ -0,0 +1,51 @@
+import json
+
+from wim import profiling
+
+
+def test_stage_records_only_when_enabled(tmp_path):
+    with profiling.stage('ignored'):
+        pass
+    assert profiling.drain() == []
+
+    profiling.enable()
+    try:
+        with profiling.file('a.jpg'):
+            for _ in range(3):
+                with profiling.stage('decode'):
+                    pass
+        with profiling.stage('save'):
+            pass
+        records = profiling.drain()
+    finally:
+        profiling.disable()
+
+    assert [(r['file'], r['stage']) for r in records] == [('a.jpg', 'decode')] * 3 + [(None, 'save')]
+    rows = profiling.summarize(records)
+    assert [(row['stage'], row['count']) for row in rows] == [('decode', 3), ('save', 1)]
+    assert 'decode' in profiling.format_table(rows)
+
+    profiling.write_trace(tmp_path / 'trace.json', records)
+    assert len(json.loads((tmp_path / 'trace.json').read_text())) == 4
+
+
+def test_percentile():
+    assert profiling.percentile([3, 1, 2, 4], 50) == 2
+    assert profiling.percentile([3, 1, 2, 4], 95) == 4
+
+
+def test_stage_records_peak_rss_growth():
+    profiling.enable()
+    try:
+        for _ in range(2):
+            with profiling.stage('allocate'):
+                data = b'x' * 2**26
+            del data
+        records = profiling.drain()
+    finally:
+        profiling.disable()
+
+    if records[0]['rss_growth'] is None:  # resource is not available on Windows
+        return
+    assert records[0]['rss_growth'] >= 2**25
+    assert records[1]['rss_growth'] < 2**25
@@ -0,0 +1,90 @@
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from wim import serve
+
+
+def test_serve_stream_processes_jobs(tmp_path):
+    path = tmp_path / 'img.png'
+    Image.new('RGB', (60, 40), (0, 128, 0)).save(path)
+    outdir = tmp_path / 'out'
+
+    jobs = [
+        {'id': 1, 'args': [str(path), '-s', '30', '30', '-o', str(outdir)]},
+        {'id': 2, 'args': ['--unknown-option']},
+        {'id': 3, 'args': ['--help']},
+        {'id': 4, 'args': [str(path), '--incremental', '-o', str(outdir)]},
+        {'id': 5, 'args': [str(path), '--dry-run', '-o', str(outdir)]},
+        {'id': 6, 'args': [str(path), '--profile-output', str(tmp_path / 'trace.json'), '-o', str(outdir)]},
+        'not json',
+    ]
+    rfile = io.StringIO('\n'.join(job if isinstance(job, str) else json.dumps(job) for job in jobs))
+    wfile = io.StringIO()
+
+    with ThreadPoolExecutor(1) as executor:
+        serve.serve_stream(rfile, wfile, executor)
+
+    responses = {response['id']: response for response in map(json.loads, wfile.getvalue().splitlines())}
+    assert responses[1]['ok']
+    assert responses[1]['files'][0]['outputs'] == [str(outdir / 'img-wim.png')]
+    assert responses[2] == {'id': 2, 'ok': False, 'error': 'invalid arguments', 'time': responses[2]['time']}
+    assert responses[3]['error'] == '--help and --version are not supported by wim serve'
+    assert responses[4]['error'] == '--incremental is not supported by wim serve'
+    assert responses[5]['error'] == '--dry-run is not supported by wim serve'
+    assert responses[6]['error'] == '--profile-output is not supported by wim serve'
+    assert not responses[None]['ok']
+    with Image.open(outdir / 'img-wim.png') as img:
+        assert img.size == (30, 20)
+
+
+def test_serve_stream_resets_max_pixels_between_jobs(tmp_path):
+    path = tmp_path / 'img.png'
+    Image.new('RGB', (60, 40)).save(path)
+    outdir = tmp_path / 'out'
+
+    jobs = [
+        {'id': 1, 'args': [str(path), '--max-pixels', '1000', '-o', str(outdir)]},
+        {'id': 2, 'args': [str(path), '-o', str(outdir)]},
+    ]
+    rfile = io.StringIO('\n'.join(map(json.dumps, jobs)))
+    wfile = io.StringIO()
+
+    # A single worker runs the jobs in sequence, like a reused worker process.
+    with ThreadPoolExecutor(1) as executor:
+        serve.serve_stream(rfile, wfile, executor)
+
+    responses = {response['id']: response for response in map(json.loads, wfile.getvalue().splitlines())}
+    assert 'decompression bomb' in responses[1]['files'][0]['error']
+    assert responses[2]['ok']
+
+
+def test_serve_stream_reports_palette_errors(tmp_path):
+    path = tmp_path / 'broken.png'
+    path.write_bytes(b'not an image')
+    job = {'id': 1, 'args': [str(path), '--quantize', '16', '--palette-sample', '1', '-o', str(tmp_path)]}
+    wfile = io.StringIO()
+
+    with ThreadPoolExecutor(1) as executor:
+        serve.serve_stream(io.StringIO(json.dumps(job)), wfile, executor)
+
+    assert json.loads(wfile.getvalue())['error'] == 'cannot build palette: no images to build a palette from'
+
+
+def test_serve_stream_survives_unexpected_errors(tmp_path, monkeypatch):
+    def iter_inputs(_):
+        msg = 'boom'
+        raise RuntimeError(msg)
+
+    monkeypatch.setattr(serve.cli, 'iter_inputs', iter_inputs)
+    jobs = [{'id': 1, 'args': [str(tmp_path / 'img.png')]}, {'id': 2, 'args': ['--unknown-option']}]
+    wfile = io.StringIO()
+
+    with ThreadPoolExecutor(1) as executor:
+        serve.serve_stream(io.StringIO('\n'.join(map(json.dumps, jobs))), wfile, executor)
+
+    responses = {response['id']: response for response in map(json.loads, wfile.getvalue().splitlines())}
+    assert responses[1]['error'] == 'RuntimeError: boom'
+    assert responses[2]['error'] == 'invalid arguments'
@@ -0,0 +1,66 @@
+import io
+
+from PIL import Image, ImageCms, PngImagePlugin
+
+from wim import cli, strip
+
+
+def make_exif(orientation=1):
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    exif[0x010F] = 'wim camera'
+    return exif
+
+
+def encode(img, img_format, **kwargs):
+    buf = io.BytesIO()
+    img.save(buf, img_format, **kwargs)
+    return buf.getvalue()
+
+
+def test_strip_jpeg_keeps_image_data():
+    img = Image.effect_noise((64, 48), 50).convert('RGB')
+    icc = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+    for progressive in (False, True):
+        data = encode(img, 'JPEG', exif=make_exif(), icc_profile=icc, comment=b'wim', progressive=progressive)
+
+        stripped = strip.strip_jpeg(data)
+        result = Image.open(io.BytesIO(stripped))
+        assert 'exif' not in result.info
+        assert 'icc_profile' not in result.info
+        assert 'comment' not in result.info
+        assert 'jfif' in result.info
+        assert result.tobytes() == Image.open(io.BytesIO(data)).tobytes()
+        # The compressed data is copied unchanged.
+        assert data.endswith(stripped[stripped.index(b'\xff\xdb') :])
+
+
+def test_strip_refuses_rotated_and_invalid_images():
+    img = Image.new('RGB', (8, 8))
+    assert strip.strip_jpeg(encode(img, 'JPEG', exif=make_exif(6))) is None
+    assert strip.strip_png(encode(img, 'PNG', exif=make_exif(6))) is None
+    assert strip.strip_jpeg(encode(img, 'JPEG')[:-10]) is None
+    assert strip.strip_metadata(encode(img, 'GIF'), 'GIF') is None
+
+
+def test_strip_png_removes_text_and_exif():
+    img = Image.effect_noise((32, 32), 50).convert('RGB')
+    info = PngImagePlugin.PngInfo()
+    info.add_text('Comment', 'wim')
+    info.add_itxt('Author', 'wim', zip=True)
+    data = encode(img, 'PNG', pnginfo=info, exif=make_exif())
+
+    result = Image.open(io.BytesIO(strip.strip_png(data)))
+    assert result.text == {}
+    assert result.getexif().get(0x010F) is None
+    assert result.tobytes() == img.tobytes()
+
+
+def test_proc_file_strip_only_copies_image_data(tmp_path, monkeypatch):
+    src = tmp_path / 'photo.jpg'
+    src.write_bytes(encode(Image.effect_noise((64, 48), 50).convert('RGB'), 'JPEG', exif=make_exif()))
+    argv = cli.get_args([str(src), '--strip', '-o', str(tmp_path / 'out')])
+
+    monkeypatch.setattr(cli, 'proc_image', None)
+    (dst,) = cli.proc_file(str(src), argv)
+    assert dst.read_bytes() == strip.strip_jpeg(src.read_bytes())
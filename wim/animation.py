@@ -0,0 +1,153 @@
+"""
+This module processes animated GIF and WebP images frame by frame.
+
+An Animation is a multi-frame image whose frames are read from the source and processed when the encoder
+seeks to them, so Image.save(save_all=True) writes the animation without holding a list of all processed
+frames. The WebP encoder takes one frame at a time, the GIF encoder keeps the palette frames it has written
+to compute the differences between frames. Durations, loop count and disposal methods of the source are kept.
+
+Classes:
+    - Animation: Multi-frame image that processes the frames of an animated source image on demand.
+
+Functions:
+    - is_animated: Check whether an opened image has more than one frame.
+
+Constants:
+    - ANIMATED_FORMATS: Output formats that can store animations.
+    - PALETTE_FRAMES: Maximum number of frames sampled to build a shared palette.
+"""
+
+import io
+from collections.abc import Callable
+
+from PIL import Image
+
+from wim.image import apply_palette, build_palette
+
+ANIMATED_FORMATS = {'gif', 'webp'}
+PALETTE_FRAMES = 8
+
+
+def is_animated(img: Image.Image) -> bool:
+    """Check whether an opened image has more than one frame, without decoding it."""
+
+    return getattr(img, 'is_animated', False)
+
+
+class Animation(Image.Image):
+    """
+    Multi-frame image that processes the frames of an animated source image on demand.
+
+    Seeking to a frame decodes it from the source, converts it to RGBA and passes it to process. If colors is
+    set, all frames are mapped to one palette, so the GIF encoder writes a single global color table. Unless
+    a palette is given, it is built from up to PALETTE_FRAMES processed frames, see wim.image.build_palette.
+
+    The durations and disposal methods of the frames are collected while the frames are visited. Pillow reads
+    them from the lists passed by save_options after it has requested the frame, so the encoder gets them
+    without a separate pass over the source.
+
+    Args:
+        data: Content of the animated image file
+        process: Function applied to each RGBA frame, it may modify the frame in place
+        colors: Number of palette colors, None to keep RGBA frames
+        palette: Shared palette image, see wim.image.load_palette, used if colors is set
+        method: Quantization method used to build the palette
+        dither: Dithering applied when mapping frames to the palette
+    """
+
+    def __init__(
+        self,
+        data: bytes,
+        process: Callable[[Image.Image], Image.Image],
+        colors: int | None = None,
+        palette: Image.Image | None = None,
+        method: Image.Quantize | None = None,
+        dither: Image.Dither = Image.Dither.NONE,
+    ):
+        super().__init__()
+        self._data = data
+        self._process = process
+        self._colors = colors
+        self._palette = palette
+        self._method = method
+        self._dither = dither
+        self._source = Image.open(io.BytesIO(data))
+        self._frame = -1
+        self.n_frames: int = getattr(self._source, 'n_frames', 1)
+        self.is_animated = True
+        self.durations: list[int] = []
+        self.disposals: list[int] = []
+        self.seek(0)
+
+    def tell(self) -> int:
+        return self._frame
+
+    def seek(self, frame: int) -> None:
+        if not 0 <= frame < self.n_frames:
+            msg = 'no more frames in animation'
+            raise EOFError(msg)
+        if frame == self._frame:
+            return
+
+        if self._colors and self._palette is None:
+            self._palette = build_palette(self._sample_frames(), self._colors, self._method)
+        self._source.seek(frame)
+        out = self._process(self._source.convert('RGBA'))
+        if self._colors:
+            out = apply_palette(out, self._palette, self._dither)  # type: ignore[arg-type]
+
+        if frame == len(self.durations):
+            self.durations.append(self._source.info.get('duration', 0))
+            if hasattr(self._source, 'disposal_method'):
+                self.disposals.append(self._source.disposal_method)
+
+        self.im = out.im
+        self._mode = out.mode
+        self._size = out.size
+        self.palette = out.palette
+        self.info = {key: out.info[key] for key in ('transparency',) if key in out.info}
+        self.info['duration'] = self.durations[frame]
+        self._frame = frame
+
+    def quantize(
+        self,
+        colors: int = 256,
+        method: int | None = None,
+        kmeans: int = 0,
+        palette: Image.Image | None = None,
+        dither: Image.Dither | None = None,
+    ) -> 'Animation':
+        """
+        Return a copy of the animation with all frames mapped to one palette, see Image.quantize.
+
+        Unless palette is given, a palette of colors entries is built from sampled frames. Method and dither
+        default to the settings of this animation, kmeans is not supported.
+        """
+        if kmeans:
+            msg = 'kmeans is not supported for animations'
+            raise ValueError(msg)
+        return Animation(
+            self._data,
+            self._process,
+            colors,
+            palette,
+            self._method if method is None else Image.Quantize(method),
+            self._dither if dither is None else dither,
+        )
+
+    def save_options(self) -> dict:
+        """Return the options Image.save needs to write all frames with their timing."""
+
+        options: dict = {'save_all': True, 'duration': self.durations}
+        if 'loop' in self._source.info:
+            options['loop'] = self._source.info['loop']
+        if self.disposals:
+            options['disposal'] = self.disposals
+        return options
+
+    def _sample_frames(self):
+        # Evenly spaced frames, processed like the frames that are saved.
+        count = min(self.n_frames, PALETTE_FRAMES)
+        for index in sorted({round(i * (self.n_frames - 1) / max(count - 1, 1)) for i in range(count)}):
+            self._source.seek(index)
+            yield self._process(self._source.convert('RGBA'))
@@ -0,0 +1,126 @@
+"""
+This module provides a streaming batch engine that overlaps reading, processing and writing of files.
+
+Files are read ahead by a pool of reader threads, processed one at a time in the calling thread and
+written by a pool of writer threads. Bounded queues between the stages limit how many files are held
+in memory at once. Results are reported in input order.
+
+Functions:
+    - capture: Call a function and capture its output and error message.
+    - pipeline: Run read, process and write stages over a sequence of names.
+"""
+
+import io
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import redirect_stdout
+from typing import Any
+
+PREFETCH = 4
+WRITERS = 2
+
+# Name of the processed file, value returned by the write stage, captured output and error message if any
+Result = tuple[str, Any, str, str | None]
+
+
+def capture(func: Callable, *args) -> tuple[Any, str, str | None]:
+    """
+    Call a function and capture what it prints as well as the error it raises, if any.
+
+    Args:
+        func: Function to call
+        *args: Arguments passed to the function
+
+    Returns:
+        tuple: Return value (None on error), captured output and error message (None on success)
+    """
+    output = io.StringIO()
+    value, error = None, None
+    with redirect_stdout(output):
+        try:
+            value = func(*args)
+        except Exception as e:  # noqa: BLE001
+            error = f'{type(e).__name__}: {e}'
+    return value, output.getvalue(), error
+
+
+def _done(result: Result) -> Future:
+    future: Future = Future()
+    future.set_result(result)
+    return future
+
+
+def _write(write: Callable, name: str, output: str, task: Any) -> Result:
+    try:
+        value = write(task)
+    except Exception as e:  # noqa: BLE001
+        return name, None, output, f'{type(e).__name__}: {e}'
+    return name, value, output, None
+
+
+def pipeline(
+    names: Iterable[str],
+    read: Callable[[str], Any],
+    process: Callable[[str, Any], Any],
+    write: Callable[[Any], Any],
+    prefetch: int = PREFETCH,
+    writers: int = WRITERS,
+) -> Iterator[Result]:
+    """
+    Run read, process and write stages over a sequence of names, overlapping I/O with processing.
+
+    Reading is I/O bound and writing mostly runs in Pillow's C code, which releases the GIL, so both overlap
+    with processing even on a single core. At most prefetch files are read ahead and at most prefetch
+    processed results wait to be written. Errors in any stage are reported for the affected file without
+    stopping the batch. Output printed by the process stage is captured and reported with the result.
+
+    Args:
+        names: Names of the files to process
+        read: Function that reads a file by name, called in reader threads
+        process: Function that processes a name and the data returned by read, called in the calling thread
+        write: Function that writes the task returned by process, called in writer threads
+        prefetch: Maximum number of files read ahead and of processed files waiting to be written
+        writers: Number of writer threads
+
+    Yields:
+        Result: Name, value returned by write, captured output and error message if any, in input order
+    """
+    names = iter(names)
+    reads: deque[tuple[str, Future]] = deque()
+    writes: deque[Future] = deque()
+
+    with ThreadPoolExecutor(prefetch, 'wim-read') as reader, ThreadPoolExecutor(writers, 'wim-write') as writer:
+
+        def fill() -> None:
+            while len(reads) < prefetch:
+                name = next(names, None)
+                if name is None:
+                    return
+                reads.append((name, reader.submit(read, name)))
+
+        fill()
+        while reads:
+            name, future = reads.popleft()
+            fill()
+
+            try:
+                data = future.result()
+            except Exception as e:  # noqa: BLE001
+                writes.append(_done((name, None, '', f'{type(e).__name__}: {e}')))
+            else:
+                task, output, error = capture(process, name, data)
+                # Free the file content before the next file is processed.
+                del data
+                if error:
+                    writes.append(_done((name, None, output, error)))
+                else:
+                    writes.append(writer.submit(_write, write, name, output, task))
+                del task
+
+            # Wait for the oldest write when the queue is full, results are yielded in input order.
+            while len(writes) >= prefetch or (writes and writes[0].done()):
+                yield writes.popleft().result()
+
+        while writes:
+            yield writes.popleft().result()
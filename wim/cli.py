@@ -1,28 +1,95 @@
 #!/usr/bin/env python
 import argparse
+import contextvars
+import html
+import io
+import itertools
+import json
+import math
 import os
+import sys
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
-from PIL import Image, ImageOps
+from PIL import Image, UnidentifiedImageError, features
 
+from wim import profiling
 from wim.__about__ import __version__
+from wim.animation import ANIMATED_FORMATS, Animation, is_animated
+from wim.batch import PREFETCH, Result, capture, pipeline
+from wim.discover import is_input, read_names, scan
 from wim.image import (
+    DITHERS,
+    EFFORTS,
+    FULL_OPACITY,
     IMAGE_FORMATS,
+    MAX_COLORS,
+    MAX_QUALITY,
+    PALETTE_SAMPLE_SIZE,
     QUANTIZE_FORMATS,
+    QUANTIZE_METHODS,
     RGBA_FORMATS,
-    add_image,
-    add_text,
+    TRANSPOSED_ORIENTATIONS,
+    Pipeline,
+    build_palette,
+    draft,
+    encode,
+    encode_max_bytes,
     get_metadata,
-    get_quality,
-    set_background,
+    get_orientation,
+    load_palette,
+    thumbnail_size,
 )
+from wim.manifest import get_entry, get_fingerprint, is_current, load_manifest, save_manifest
+from wim.strip import strip_metadata
+
+STDIN = '-'
+# Options that require decoding and re-encoding the image.
+PIXEL_OPTIONS = ('effort', 'formats', 'max_bytes', 'quality', 'quantize', 'scale', 'sizes', 'text', 'trim', 'watermark')
+# Pillow's decompression bomb limit, restored for runs without --max-pixels.
+DEFAULT_MAX_PIXELS = Image.MAX_IMAGE_PIXELS
 
 
 def get_args(args=None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description='Add text and manipulate images.')
 
     parser.add_argument(
-        'filename', type=str, nargs='+', help='Input image filename. Use wildcard to process multiple files.'
+        'filename',
+        type=str,
+        nargs='*',
+        help='Input image filename. Use wildcard to process multiple files or - to read from stdin.',
+    )
+    parser.add_argument(
+        '--effort',
+        choices=EFFORTS,
+        help='Encoder effort: fast saves quickly with larger files, max tries harder for the smallest files.',
+    )
+    parser.add_argument(
+        '--calibration',
+        help='Benchmark results written by bin/benchmark.py --output, used by --dry-run to project the runtime.',
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Read only the image headers and report outputs, steps, estimated memory and projected runtime.',
+    )
+    parser.add_argument(
+        '--dither',
+        choices=DITHERS,
+        help='Dithering used to map images to a shared --palette or --palette-sample palette (default: none).',
+    )
+    parser.add_argument(
+        '--exclude',
+        action='append',
+        default=[],
+        help='Skip files found by --recursive or --files-from whose path or name matches this glob, repeatable.',
+    )
+    parser.add_argument(
+        '--files-from',
+        help='Read input file names from this file, one per line, or from stdin if -.',
     )
     parser.add_argument(
         '--font',
@@ -31,24 +98,114 @@ def get_args(args=None) -> argparse.Namespace:
     parser.add_argument('--font-size', type=int, help='Set the font size, requires font setting.')
     parser.add_argument(
         '--format',
-        choices=IMAGE_FORMATS,
-        help='Output format (overrides input format)',
+        help=f'Output format (overrides input format), one of {", ".join(sorted(IMAGE_FORMATS))}. '
+        'Separate multiple formats by commas to create them from a single processing pass, e.g., webp,jpeg.',
+    )
+    parser.add_argument(
+        '--include',
+        action='append',
+        default=[],
+        help='Only process files found by --recursive or --files-from whose path or name matches this glob, '
+        'repeatable.',
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Skip input files whose source and options have not changed since the last run.',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of images to process in parallel (default: number of CPU cores).',
+    )
+    parser.add_argument(
+        '--max-pixels',
+        type=int,
+        help='Maximum number of pixels of input images, Pillow refuses images more than twice as large as '
+        'decompression bombs. 0 disables the check (default: Pillow default).',
+    )
+    parser.add_argument(
+        '--memory-limit',
+        type=int,
+        help='Fail images estimated to need more than this many MB before they are decoded. This is a check of '
+        'the estimated peak, not a limit enforced while processing.',
+    )
+    parser.add_argument(
+        '--manifest',
+        default='.wim-manifest.json',
+        help='Path of the manifest file used by --incremental (default: .wim-manifest.json).',
+    )
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=PREFETCH,
+        help=f'Number of files read ahead and waiting to be saved when --jobs is 1 (default: {PREFETCH}).',
     )
     parser.add_argument('--output-label', default='-wim', help='Label to append to the output file name.')
+    parser.add_argument(
+        '--palette',
+        help='Map quantized images to the colors of this image, images not in P mode are quantized to --quantize colors.',
+    )
+    parser.add_argument(
+        '--palette-sample',
+        type=int,
+        metavar='N',
+        help='Map quantized images to one palette built from the first N input files.',
+    )
+    parser.add_argument(
+        '--max-bytes',
+        type=int,
+        help='Maximum output file size in bytes. Searches the highest quality for JPEG and WebP and the highest '
+        'number of quantization colors for PNG and GIF that fit, at most --quantize colors. Images mapped to a '
+        'shared palette and quantized animations keep their colors.',
+    )
+    parser.add_argument(
+        '--profile', action='store_true', help='Print time and memory used per processing stage at the end.'
+    )
+    parser.add_argument('--profile-output', help='Write per-file, per-stage timings to a JSON or CSV file.')
     parser.add_argument(
         '--quality', type=int, help='Output quality 1-100 (lower = smaller file). Works with JPEG and WebP.'
     )
+    parser.add_argument(
+        '-r',
+        '--recursive',
+        action='append',
+        default=[],
+        metavar='DIR',
+        help='Process images in this directory and its subdirectories, repeatable. Files with image extensions '
+        'are processed as they are found, outputs with the output label are skipped.',
+    )
     parser.add_argument('--quantize', type=int, help='Quantize the image with the desired number of colors, <= 256.')
+    parser.add_argument(
+        '--quantize-method',
+        choices=QUANTIZE_METHODS,
+        help='Method used to build palettes, default: mediancut, fastoctree for images with alpha channel.',
+    )
     parser.add_argument(
         '-s',
         '--scale',
         type=int,
         nargs=2,
+        action='append',
         metavar=('WIDTH', 'HEIGHT'),
-        help='Set the maximum width and height as integer values.',
+        help='Set the maximum width and height as integer values. Repeat to create several sizes from one decode, '
+        'output file names get the image width appended, e.g., photo-wim-800w.jpg.',
+    )
+    parser.add_argument(
+        '--srcset',
+        choices=['html', 'json'],
+        help='Write an HTML img tag or JSON file with the srcset of the sizes created by multiple --scale options.',
     )
     parser.add_argument('--strip', action='store_true', help='Strip image of all metadata.')
     parser.add_argument('-t', '--text', help='Set the text to append at the bottom of the image.')
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=1,
+        help='Split flattening, compositing and watermark opacity of each image into bands for this many threads.',
+    )
     parser.add_argument('--trim', action='store_true', help='Trim uniform-color borders from image edges.')
     parser.add_argument('-w', '--watermark', help='Path to watermark/overlay image to add to the image.')
     parser.add_argument(
@@ -72,93 +229,854 @@ def get_args(args=None) -> argparse.Namespace:
         '-i', '--inplace', action='store_true', help='Edit the image in place (overwrites original).'
     )
     output_group.add_argument('-o', '--outdir', help='Output directory for processed images.')
+    output_group.add_argument(
+        '--stdout', action='store_true', help='Write the processed image to stdout, messages go to stderr.'
+    )
     argv = parser.parse_args(args)
 
     if argv.inplace and argv.format:
         parser.error('--format cannot be used with --inplace (inplace preserves original format)')
 
+    # Multiple formats share all processing steps except quantization, background and quality settings.
+    argv.formats = None
+    if argv.format:
+        formats = list(dict.fromkeys(argv.format.lower().split(',')))
+        for img_format in formats:
+            if img_format not in IMAGE_FORMATS:
+                parser.error(f'invalid format: {img_format!r} (choose from {", ".join(sorted(IMAGE_FORMATS))})')
+        argv.format = formats[0]
+        if len(formats) > 1:
+            argv.formats = formats
+
     if argv.font_size and not argv.font:
         parser.error('--font-size requires --font to be specified')
 
+    if argv.incremental and argv.inplace:
+        parser.error('--incremental cannot be used with --inplace (inplace edits modify the source files)')
+
+    if argv.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    if argv.max_bytes is not None and argv.max_bytes < 1:
+        parser.error('--max-bytes must be at least 1')
+
+    if argv.max_pixels is not None and argv.max_pixels < 0:
+        parser.error('--max-pixels must not be negative')
+
+    if argv.memory_limit is not None and argv.memory_limit < 1:
+        parser.error('--memory-limit must be at least 1')
+
+    if argv.prefetch < 1:
+        parser.error('--prefetch must be at least 1')
+
+    if argv.quality is not None and not 1 <= argv.quality <= MAX_QUALITY:
+        parser.error(f'--quality must be between 1 and {MAX_QUALITY}')
+
+    if argv.quantize is not None and not 1 <= argv.quantize <= MAX_COLORS:
+        parser.error(f'--quantize must be between 1 and {MAX_COLORS}')
+
+    if not 0 <= argv.watermark_opacity <= FULL_OPACITY:
+        parser.error(f'--watermark-opacity must be between 0 and {FULL_OPACITY}')
+
+    if (argv.palette or argv.palette_sample or argv.quantize_method) and not argv.quantize:
+        parser.error('--palette, --palette-sample and --quantize-method require --quantize')
+
+    if argv.palette and argv.palette_sample:
+        parser.error('--palette cannot be used with --palette-sample')
+
+    if argv.palette_sample is not None and argv.palette_sample < 1:
+        parser.error('--palette-sample must be at least 1')
+
+    if argv.dither and not (argv.palette or argv.palette_sample):
+        parser.error('--dither requires --palette or --palette-sample')
+
+    if argv.quantize_method == 'libimagequant' and not features.check_feature('libimagequant'):
+        parser.error('--quantize-method libimagequant is not supported by this Pillow installation')
+
+    # Set by set_palette, so the palette is sent to worker processes with the other settings.
+    argv.palette_image = None
+
+    if argv.threads < 1:
+        parser.error('--threads must be at least 1')
+
+    # argv.scale is the largest box, the order of sizes and the largest output depend on the aspect ratio of
+    # each image, see sort_sizes and get_scale.
+    argv.sizes = None
+    if argv.scale:
+        sizes = sorted({tuple(size) for size in argv.scale}, key=lambda size: size[0] * size[1], reverse=True)
+        argv.scale = list(sizes[0])
+        if len(sizes) > 1:
+            argv.sizes = [list(size) for size in sizes]
+
+    if argv.sizes and argv.inplace:
+        parser.error('multiple --scale sizes cannot be used with --inplace')
+
+    if argv.srcset and not argv.sizes:
+        parser.error('--srcset requires multiple --scale sizes')
+
+    if not (argv.filename or argv.recursive or argv.files_from):
+        parser.error('no input files, give file names, --recursive or --files-from')
+
+    for directory in argv.recursive:
+        if not os.path.isdir(directory):
+            parser.error(f'--recursive {directory}: no such directory')
+
+    if argv.files_from and argv.files_from != STDIN and not os.path.exists(argv.files_from):
+        parser.error(f'--files-from {argv.files_from}: no such file')
+
+    if argv.files_from == STDIN and STDIN in argv.filename:
+        parser.error('--files-from - cannot be used when reading an image from stdin')
+
+    if STDIN in argv.filename and not argv.stdout:
+        parser.error('reading from stdin requires --stdout')
+
+    if argv.calibration and not argv.dry_run:
+        parser.error('--calibration requires --dry-run')
+
+    if argv.stdout:
+        if argv.dry_run:
+            parser.error('--dry-run cannot be used with --stdout')
+        if len(argv.filename) != 1 or argv.recursive or argv.files_from:
+            parser.error('--stdout requires a single input file')
+        if argv.sizes or argv.formats or argv.incremental:
+            parser.error('--stdout cannot be used with multiple sizes, multiple formats or --incremental')
+
     return argv
 
 
-def get_dst(src: Path, argv: argparse.Namespace) -> Path:
-    """Return destination path and ensure argv.format is set."""
+def get_dst(src: Path, argv: argparse.Namespace, suffix: str = '', *, mkdir: bool = True) -> Path:
+    """
+    Return destination path with an optional suffix appended to the stem and ensure argv.format is set.
 
+    The output directory is created unless mkdir is False.
+    """
     if argv.inplace:
         return src
 
     parent = Path(argv.outdir) if argv.outdir else src.parent
-    parent.mkdir(exist_ok=True)
+    if mkdir:
+        parent.mkdir(exist_ok=True)
     argv.format = argv.format if argv.format else src.suffix.lstrip('.').lower()
-    return parent / f'{src.stem}{argv.output_label}.{argv.format}'
+    return parent / f'{src.stem}{argv.output_label}{suffix}.{argv.format}'
 
 
-def proc_image(img: Image.Image, argv: argparse.Namespace):
-    # First make sure the image orientation is correct.
-    img = ImageOps.exif_transpose(img)  # type: ignore
+def is_strip_only(argv: argparse.Namespace) -> bool:
+    """Check whether --strip is the only option that changes the output, so no decoding is needed."""
 
-    # Extract metadata before further image processing.
-    save_kwargs = {} if argv.strip else get_metadata(img)
+    return bool(argv.strip) and not any(getattr(argv, name) for name in PIXEL_OPTIONS)
+
+
+def _report_directory(error: OSError) -> None:
+    print(f'Warning: skipping directory {error.filename}: {error.strerror}', file=sys.stderr)
+
+
+def iter_inputs(argv: argparse.Namespace) -> Iterator[str]:
+    """
+    Yield the input file names: file names given as arguments, then files read from --files-from and found in
+    --recursive directories as they are discovered, filtered by extension, --include and --exclude.
+    """
+    yield from argv.filename
+
+    filters = {'include': argv.include, 'exclude': argv.exclude, 'output_label': argv.output_label}
+    if argv.files_from:
+        yield from (name for name in read_names(argv.files_from) if is_input(name, **filters))
+    for directory in argv.recursive:
+        yield from scan(directory, _report_directory, **filters)
+
+
+def set_pixel_limit(argv: argparse.Namespace) -> None:
+    """
+    Set the decompression bomb limit of Pillow from --max-pixels, this must happen before opening images.
+
+    The limit is global, so it's always set. Otherwise a worker process of wim serve would keep the limit of a
+    previous job.
+    """
+    if argv.max_pixels is None:
+        Image.MAX_IMAGE_PIXELS = DEFAULT_MAX_PIXELS
+    else:
+        Image.MAX_IMAGE_PIXELS = argv.max_pixels or None
+
+
+def _pixel_bytes(mode: str) -> int:
+    # Pillow stores RGB and most other modes with 4 bytes per pixel.
+    if mode in ('1', 'L', 'P'):
+        return 1
+    return 2 if mode.startswith('I;16') else 4
+
+
+def sort_sizes(size: tuple[int, int], sizes: Iterable[tuple[int, int]]) -> list[tuple[int, int]]:
+    """
+    Return --scale sizes ordered by the size they scale an image of the given size to, largest first.
+
+    The output size depends on the aspect ratio of the image, e.g., 1000x100 gives a smaller output than 300x300
+    for a square image, so the order can only be determined per image.
+    """
+    return sorted(sizes, key=lambda max_size: math.prod(thumbnail_size(size, max_size)), reverse=True)
+
+
+def get_scale(img: Image.Image, argv: argparse.Namespace) -> tuple[int, int] | None:
+    """Return the --scale size that gives the largest output for an opened image in its EXIF orientation."""
+
+    if not argv.sizes:
+        return argv.scale
+    size = img.size[::-1] if get_orientation(img) in TRANSPOSED_ORIENTATIONS else img.size
+    return sort_sizes(size, argv.sizes)[0]
+
+
+def estimate_memory(img: Image.Image, argv: argparse.Namespace) -> int:
+    """
+    Estimate the peak memory in bytes needed to process an opened image that has not been decoded yet.
+
+    Call this after draft, so a reduced-size decode is taken into account. Transposing and trimming hold two
+    full-size frames at once. The decoded frame is kept until the outputs are saved, scaled outputs, the RGBA
+    copy needed for overlays and the copy with black background are added to it.
+    """
+    frame = img.width * img.height * _pixel_bytes(img.mode)
+    orientation = get_orientation(img)
+    peak = frame * 2 if argv.trim or orientation != 1 else frame
+
+    width, height = img.size
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    scale = get_scale(img, argv)
+    if scale:
+        ratio = min(1, scale[0] / width, scale[1] / height)
+        width, height = max(round(width * ratio), 1), max(round(height * ratio), 1)
+
+    formats = argv.formats or [argv.format]
+    overlays = bool(argv.text or argv.watermark)
+    # Overlays are blended into the image itself, unless it's converted to RGBA or multiple sizes are created.
+    converted = img.mode != 'RGBA' and (img.mode != 'RGB' or bool(RGBA_FORMATS.intersection(formats)))
+    overlay_copy = overlays and (converted or bool(argv.sizes))
+    flatten = any(img_format not in RGBA_FORMATS for img_format in formats) and (
+        'A' in img.getbands() or (overlays and converted)
+    )
+    copies = bool(scale) + overlay_copy + flatten
+    return max(peak, frame + width * height * 4 * copies)
+
+
+def set_palette(argv: argparse.Namespace, names: Iterable[str]) -> Iterable[str]:
+    """
+    Load or build the palette shared by all images for --palette or --palette-sample and return the input names.
+
+    The palette is stored as argv.palette_image. With --palette-sample, reduced copies of the first input files
+    are read to build it, the returned names start with the sampled files again. Files that can't be read are
+    left out of the sample, they fail when they are processed.
+
+    Raises:
+        OSError: If the --palette file can't be read
+        ValueError: If none of the sampled files can be read, e.g., because the input is stdin
+    """
+    method = QUANTIZE_METHODS.get(argv.quantize_method)
+    if argv.palette:
+        argv.palette_image = load_palette(argv.palette, argv.quantize, method)
+        return names
+
+    if not argv.palette_sample:
+        return names
+
+    names = iter(names)
+    sample = list(itertools.islice(names, argv.palette_sample))
+
+    def read_samples() -> Iterator[Image.Image]:
+        for name in sample:
+            if name == STDIN:
+                continue
+            try:
+                with Image.open(name) as img:
+                    draft(img, PALETTE_SAMPLE_SIZE)
+                    img.load()
+                    yield img
+            except OSError:
+                continue
+
+    with profiling.stage('build_palette'):
+        argv.palette_image = build_palette(read_samples(), argv.quantize, method)
+    return itertools.chain(sample, names)
+
+
+def get_pipeline(argv: argparse.Namespace) -> Pipeline:
+    """
+    Create the processing pipeline for the command line options, see wim.image.Pipeline.
+
+    load_file and proc_stream create it once per file and pass it to the step functions. The output formats
+    aren't passed, because the steps are applied per format.
+    """
+    return Pipeline(
+        scale=argv.scale,
+        text=argv.text,
+        font=argv.font,
+        font_size=argv.font_size,
+        watermark=argv.watermark,
+        watermark_position=argv.watermark_position,
+        watermark_scale=argv.watermark_scale,
+        watermark_opacity=argv.watermark_opacity,
+        quality=argv.quality,
+        effort=argv.effort,
+        max_bytes=argv.max_bytes,
+        quantize=argv.quantize,
+        palette=argv.palette_image,
+        quantize_method=argv.quantize_method,
+        dither=argv.dither or 'none',
+        strip=argv.strip,
+        trim=argv.trim,
+        threads=argv.threads,
+    )
+
+
+def get_save_options(argv: argparse.Namespace) -> dict:
+    """Return the encoder settings of save_file for the command line options."""
+
+    return {
+        'max_bytes': argv.max_bytes,
+        'effort': argv.effort,
+        'colors': argv.quantize,
+        'method': QUANTIZE_METHODS.get(argv.quantize_method),
+    }
+
+
+def prepare_image(img: Image.Image, argv: argparse.Namespace, steps: Pipeline, *, inplace: bool = False):
+    """
+    Decode and apply the processing steps that come before scaling, see Pipeline.prepare.
+
+    If inplace is set, img must be an opened image that belongs to the caller of load_file or proc_stream. It's
+    then decoded at reduced size when it's scaled down and transposed in place. Otherwise the returned image is
+    a copy and img is not modified.
+    """
+
+    # Decode a reduced-size version if the image is scaled down. Trimmed images are decoded at full size,
+    # because the size of the trimmed area is unknown before decoding.
+    scale = get_scale(img, argv)
+    if inplace and scale and not argv.trim:
+        draft(img, scale)
+
+    if argv.memory_limit:
+        needed = estimate_memory(img, argv)
+        if needed > argv.memory_limit * 2**20:
+            msg = f'processing needs about {needed / 2**20:.0f}MB, more than --memory-limit {argv.memory_limit}MB'
+            raise MemoryError(msg)
+
+    with profiling.stage('decode'):
+        img.load()
+
+    if argv.quantize and not argv.formats and argv.format not in QUANTIZE_FORMATS:
+        print(f'Skipping quantization, not supported for: {argv.format}')
+
+    return steps.prepare(img, inplace=inplace)
+
+
+def finish_image(img: Image.Image, argv: argparse.Namespace, steps: Pipeline, *, inplace: bool = False) -> Image.Image:
+    """
+    Apply the processing steps that come after scaling, modify img itself if inplace is set.
+
+    With multiple formats, the format steps are applied by format_images, see Pipeline.finish.
+    """
+    return steps.finish(img, argv.formats or [argv.format], inplace=inplace, encoding=True)
+
+
+def proc_image(img: Image.Image, argv: argparse.Namespace, steps: Pipeline, *, inplace: bool = False):
+    """Process an image for a single output size and return it with its save options, see prepare_image."""
+
+    img, save_kwargs = prepare_image(img, argv, steps, inplace=inplace)
 
     # Quality settings are applied when saving the image.
-    if argv.quality:
-        save_kwargs.update(get_quality(argv.quality, argv.format))
+    if not argv.formats:
+        save_kwargs.update(steps.save_options(argv.format))
+
+    if argv.scale:
+        with profiling.stage('thumbnail'):
+            img.thumbnail(argv.scale)
 
-    # Apply trim before other image manipulations.
+    # The prepared image belongs to this function, overlays are blended into it without copying.
+    return finish_image(img, argv, steps, inplace=True), save_kwargs
+
+
+def proc_sizes(
+    img: Image.Image, argv: argparse.Namespace, steps: Pipeline, *, inplace: bool = False
+) -> tuple[list[Image.Image], dict]:
+    """
+    Create one image per size in argv.sizes from a single decode.
+
+    Sizes are processed from largest to smallest and each size is scaled down from the previous result.
+    Sizes that don't reduce the previous result are skipped. See prepare_image for inplace.
+    """
+    img, save_kwargs = prepare_image(img, argv, steps, inplace=inplace)
+
+    if not argv.formats:
+        save_kwargs.update(steps.save_options(argv.format))
+
+    images: list[Image.Image] = []
+    for size in sort_sizes(img.size, argv.sizes):
+        # Don't scale an image that finish_image returned unchanged and that is therefore in the results.
+        if images and images[-1] is img:
+            img = img.copy()
+
+        previous = img.size
+        with profiling.stage('thumbnail'):
+            img.thumbnail(size)
+        if images and img.size == previous:
+            print(f'Skipping --scale {size[0]} {size[1]}, the output has the same size as for a larger --scale')
+            continue
+
+        images.append(finish_image(img, argv, steps))
+
+    return images, save_kwargs
+
+
+def format_images(
+    img: Image.Image, argv: argparse.Namespace, steps: Pipeline, save_kwargs: dict
+) -> list[tuple[Image.Image, dict]]:
+    """
+    Apply the format-dependent steps to a processed image for each format in argv.formats.
+
+    Quantization, the black background for formats without alpha channel and quality settings differ per
+    format, see Pipeline.convert.
+
+    Returns:
+        list: Image and save options for each format
+    """
+    if argv.quantize and not QUANTIZE_FORMATS.intersection(argv.formats):
+        print(f'Skipping quantization, not supported for: {", ".join(argv.formats)}')
+
+    images = steps.convert(img, argv.formats, encoding=True)
+    return [
+        (out, {**save_kwargs, **steps.save_options(img_format)})
+        for img_format, out in zip(argv.formats, images, strict=True)
+    ]
+
+
+def is_animation(img: Image.Image, argv: argparse.Namespace) -> bool:
+    """Check whether an image is animated and all output formats can store the animation."""
+
+    return is_animated(img) and ANIMATED_FORMATS.issuperset(argv.formats or [argv.format])
+
+
+def proc_animation(
+    img: Image.Image, data: bytes, argv: argparse.Namespace, steps: Pipeline
+) -> list[tuple[Animation, str, dict]]:
+    """
+    Create an animation for each size and format from an animated image, see wim.animation.
+
+    Frames are processed while they are saved. Text tiles and watermarks are prepared once and cached, see
+    render_text and prepare_overlay. Trimming is skipped, because the frames could be trimmed to different
+    sizes.
+
+    Returns:
+        list: Animation, output format and save options for each size and format
+    """
     if argv.trim:
-        img = ImageOps.crop(img)
+        print('Skipping trim, not supported for animations')
+    formats = argv.formats or [argv.format]
+    if argv.quantize and not QUANTIZE_FORMATS.intersection(formats):
+        print(f'Skipping quantization, not supported for: {", ".join(formats)}')
+    save_kwargs = {} if argv.strip else get_metadata(img)
 
-    if argv.quantize:
-        if argv.format not in QUANTIZE_FORMATS:
-            print(f'Skipping quantization, not supported for: {argv.format}')
-        else:
-            img = img.quantize(colors=argv.quantize)  # type: ignore
+    # Like proc_sizes, skip sizes that don't reduce the previous size.
+    sizes: list[tuple[int, int] | None] = []
+    size = img.size
+    for max_size in sort_sizes(size, argv.sizes) if argv.sizes else [argv.scale]:
+        previous, size = size, thumbnail_size(size, max_size) if max_size else size
+        if not sizes or size != previous:
+            sizes.append(max_size)
 
-    if argv.scale:
-        img.thumbnail(argv.scale)
+    results = []
+    for max_size in sizes:
+        for img_format in formats:
+            # Frames are mapped to the palette of the animation, not quantized each, see Pipeline.process_frame.
+            colors = argv.quantize if img_format in QUANTIZE_FORMATS else None
+            animation = Animation(
+                data,
+                partial(steps.process_frame, img_format=img_format, scale=max_size),
+                colors,
+                steps.palette,
+                steps.quantize_method,
+                steps.dither,
+            )
+            kwargs = {**save_kwargs, **animation.save_options(), **steps.save_options(img_format)}
+            results.append((animation, img_format, kwargs))
+
+    return results
 
-    if argv.text:
-        img = add_text(img, argv.font, argv.font_size, argv.text)
 
-    if argv.watermark:
-        img = add_image(
-            img,
-            argv.watermark,
-            position=argv.watermark_position,
-            scale=argv.watermark_scale,
-            opacity=argv.watermark_opacity,
-        )
+def read_file(name) -> tuple[io.BytesIO, os.stat_result]:
+    """Read the content of an input file into memory and return it with the file's stat result."""
+
+    src = Path(name)
+    with profiling.file(name), profiling.stage('read'):
+        # The stat call must take place before save because inplace edits modify the original image.
+        stat = src.stat()
+        return io.BytesIO(src.read_bytes()), stat
 
-    # Turn into RGB with black background if necessary
-    if img.mode == 'RGBA' and argv.format not in RGBA_FORMATS:
-        img = set_background(img)
 
-    return img, save_kwargs
+def load_file(
+    name, argv: argparse.Namespace, fp=None
+) -> tuple[list[tuple[Image.Image | bytes, Path, dict]], Path | None]:
+    """
+    Open and process an input file, fp can be used to pass file content that was already read.
 
+    If --strip is the only option that changes the output, the metadata is removed from the file content
+    without decoding the image, see wim.strip. The output is then the content of the output file.
 
-def proc_file(name, argv: argparse.Namespace):
-    img = Image.open(name)
+    Returns:
+        tuple: List of output images or file contents with their destination paths and save options, srcset
+            file path or None
+    """
+    set_pixel_limit(argv)
+    try:
+        img = Image.open(fp or name)
+    except UnidentifiedImageError:
+        # Report the file name instead of the in-memory buffer.
+        msg = f'cannot identify image file {name!r}'
+        raise UnidentifiedImageError(msg) from None
 
+    # Use a per-file copy of the settings, get_dst sets the output format for this file only.
+    argv = argparse.Namespace(**vars(argv))
     src = Path(name)
-    # The stat call must take place before save because inplace edits modify the original image.
-    stat = src.stat()
     dst = get_dst(src, argv)
 
-    # Process and save image
-    img, save_kwargs = proc_image(img, argv)
-    print(f'Save image as: {dst}')
-    img.save(dst, **save_kwargs)
+    outputs: list[tuple[Image.Image | bytes, Path, dict]] = []
+    if is_strip_only(argv) and Image.registered_extensions().get(f'.{dst.suffix.lstrip(".").lower()}') == img.format:
+        with profiling.stage('strip'):
+            data = strip_metadata(fp.getvalue() if fp else src.read_bytes(), img.format)
+        if data is not None:
+            outputs.append((data, dst, {}))
 
-    # Keep timestamps of original image.
-    os.utime(dst, (stat.st_atime, stat.st_mtime))
+    images: list[Image.Image] = []
+    if not outputs:
+        steps = get_pipeline(argv)
+        if is_animation(img, argv):
+            data = fp.getvalue() if fp else src.read_bytes()
+            for animation, img_format, kwargs in proc_animation(img, data, argv, steps):
+                suffix = f'-{animation.width}w' if argv.sizes else ''
+                format_argv = argparse.Namespace(**{**vars(argv), 'format': img_format})
+                outputs.append((animation, get_dst(src, format_argv, suffix), kwargs))
+        elif argv.sizes:
+            images, save_kwargs = proc_sizes(img, argv, steps, inplace=True)
+        else:
+            processed, save_kwargs = proc_image(img, argv, steps, inplace=True)
+            images = [processed]
+
+    for image in images:
+        suffix = f'-{image.width}w' if argv.sizes else ''
+        if argv.formats:
+            formatted = format_images(image, argv, steps, save_kwargs)
+            for img_format, (out, kwargs) in zip(argv.formats, formatted, strict=True):
+                format_argv = argparse.Namespace(**{**vars(argv), 'format': img_format})
+                outputs.append((out, get_dst(src, format_argv, suffix), kwargs))
+        else:
+            outputs.append((image, get_dst(src, argv, suffix), save_kwargs))
+
+    srcset = None
+    if argv.srcset:
+        srcset = dst.with_name(f'{src.stem}{argv.output_label}-srcset.{argv.srcset}')
+
+    for _, path, _ in outputs:
+        print(f'Save image as: {path}')
+    return outputs, srcset
+
+
+def save_file(
+    outputs: list[tuple[Image.Image | bytes, Path, dict]],
+    stat: os.stat_result,
+    srcset: Path | None = None,
+    max_bytes: int | None = None,
+    effort: str | None = None,
+    colors: int | None = None,
+    method: Image.Quantize | None = None,
+) -> list[Path]:
+    """
+    Save output images, keep the timestamps of the original image and write the srcset file if requested.
+
+    Multiple outputs are encoded concurrently, Pillow releases the GIL while encoding. If max_bytes is set,
+    images are encoded in memory to find settings that fit and only the chosen encode is written. PNG and GIF
+    images that aren't quantized yet are then quantized with at most colors, see encode_max_bytes. The max
+    effort preset encodes PNG images with several strategies in memory and writes the smallest.
+    """
+
+    def save(img: Image.Image | bytes, dst: Path, save_kwargs: dict) -> None:
+        img_format = dst.suffix.lstrip('.').lower()
+        with profiling.stage('save'):
+            if isinstance(img, bytes):
+                dst.write_bytes(img)
+            elif max_bytes:
+                data = encode_max_bytes(
+                    img, img_format, max_bytes, save_kwargs, effort=effort, colors=colors, method=method
+                )
+                dst.write_bytes(data)
+                if len(data) > max_bytes:
+                    print(f'Warning: {dst} is {len(data)} bytes, larger than {max_bytes}', file=sys.stderr)
+            elif effort == 'max' and img_format == 'png':
+                dst.write_bytes(encode(img, img_format, effort, **save_kwargs))
+            else:
+                img.save(dst, **save_kwargs)
+
+        # Keep timestamps of original image.
+        os.utime(dst, (stat.st_atime, stat.st_mtime))
+
+    if len(outputs) == 1:
+        save(*outputs[0])
+    else:
+        # Image.save stores the save options on the image, so outputs that share an image save a copy.
+        seen = set()
+        with ThreadPoolExecutor(min(len(outputs), os.cpu_count() or 1)) as executor:
+            futures = []
+            for img, dst, save_kwargs in outputs:
+                out = img.copy() if isinstance(img, Image.Image) and id(img) in seen else img
+                seen.add(id(img))
+                futures.append(executor.submit(contextvars.copy_context().run, save, out, dst, save_kwargs))
+            for future in futures:
+                future.result()
+
+    if srcset:
+        write_srcset(srcset, [(dst, img.size) for img, dst, _ in outputs if isinstance(img, Image.Image)])
+
+    return [dst for _, dst, _ in outputs]
+
+
+def write_srcset(path: Path, images: list[tuple[Path, tuple[int, int]]]) -> None:
+    """
+    Write an HTML picture or img tag or a JSON file, depending on the path suffix.
+
+    Images are grouped by format in the order they are given, the last format is used for the fallback img
+    tag and the other formats become sources of a picture tag.
+    """
+    groups: dict[str, list[tuple[Path, tuple[int, int]]]] = {}
+    for dst, size in images:
+        groups.setdefault(dst.suffix, []).append((dst, size))
+
+    sources = [
+        {
+            'type': Image.MIME.get(Image.registered_extensions().get(suffix, ''), ''),
+            'srcset': ', '.join(f'{dst.name} {width}w' for dst, (width, _) in group),
+        }
+        for suffix, group in groups.items()
+    ]
+    fallback = list(groups.values())[-1]
+    src, (width, height) = fallback[0]
+
+    if path.suffix == '.json':
+        data = {
+            'src': src.name,
+            'srcset': sources[-1]['srcset'],
+            'images': [{'file': dst.name, 'width': w, 'height': h} for dst, (w, h) in fallback],
+        }
+        if len(sources) > 1:
+            data['sources'] = sources[:-1]
+        path.write_text(json.dumps(data, indent=2), encoding='utf-8')
+        return
+
+    tag = (
+        f'<img src="{html.escape(src.name)}" srcset="{html.escape(sources[-1]["srcset"])}" '
+        f'width="{width}" height="{height}" alt="">'
+    )
+    if len(sources) > 1:
+        lines = [
+            f'<source type="{source["type"]}" srcset="{html.escape(source["srcset"])}">' for source in sources[:-1]
+        ]
+        tag = '\n  '.join(['<picture>', *lines, tag]) + '\n</picture>'
+    path.write_text(f'{tag}\n', encoding='utf-8')
+
+
+def proc_stream(name, argv: argparse.Namespace, out) -> None:
+    """
+    Process an input file or stdin if name is - and write the result to a binary stream.
+
+    The input format is detected from the content and used as output format unless --format is set.
+    """
+    data = sys.stdin.buffer.read() if name == STDIN else Path(name).read_bytes()
+    set_pixel_limit(argv)
+    try:
+        img = Image.open(io.BytesIO(data))
+    except UnidentifiedImageError:
+        msg = f'cannot identify image file {name!r}'
+        raise UnidentifiedImageError(msg) from None
+
+    argv = argparse.Namespace(**vars(argv))
+    argv.format = argv.format or (img.format or '').lower()
+    if argv.format not in IMAGE_FORMATS:
+        msg = f'cannot infer output format from {img.format} input, use --format'
+        raise ValueError(msg)
+
+    steps = get_pipeline(argv)
+    processed: Image.Image
+    if is_animation(img, argv):
+        processed, _, save_kwargs = proc_animation(img, data, argv, steps)[0]
+    else:
+        processed, save_kwargs = proc_image(img, argv, steps, inplace=True)
+    with profiling.file(name), profiling.stage('save'):
+        encoded = steps.encode(processed, argv.format, save_kwargs)
+        if argv.max_bytes and len(encoded) > argv.max_bytes:
+            print(f'Warning: output is {len(encoded)} bytes, larger than {argv.max_bytes}', file=sys.stderr)
+        out.write(encoded)
+    out.flush()
+
+
+def proc_file(name, argv: argparse.Namespace) -> list[Path]:
+    with profiling.file(name):
+        # The stat call must take place before save because inplace edits modify the original image.
+        stat = Path(name).stat()
+        outputs, srcset = load_file(name, argv)
+        return save_file(outputs, stat, srcset, **get_save_options(argv))
+
+
+def run_job(name, argv: argparse.Namespace) -> tuple[Result, list[dict]]:
+    """Process a single file and return its result and profiling records."""
+
+    if argv.profile:
+        profiling.enable()
+    dsts, output, error = capture(proc_file, name, argv)
+    return (name, dsts, output, error), profiling.drain()
+
+
+def run_pool(names: Iterable[str], argv: argparse.Namespace, executor: ProcessPoolExecutor, jobs: int):
+    """
+    Process files in worker processes and collect their profiling records in this process.
+
+    Names are submitted as results are consumed, at most twice as many as there are workers, so names that are
+    still being discovered don't pile up in memory.
+    """
+    futures: deque[Future] = deque()
+    for name in names:
+        futures.append(executor.submit(run_job, name, argv))
+        if len(futures) >= jobs * 2:
+            result, records = futures.popleft().result()
+            profiling.add_records(records)
+            yield result
+
+    while futures:
+        result, records = futures.popleft().result()
+        profiling.add_records(records)
+        yield result
+
+
+def run_pipeline(names: Iterable[str], argv: argparse.Namespace):
+    """Process files in the current process, overlapping reading and saving with image processing."""
+
+    def process(name, data):
+        fp, stat = data
+        with profiling.file(name):
+            outputs, srcset = load_file(name, argv, fp)
+        return name, outputs, stat, srcset
+
+    def write(task):
+        name, *args = task
+        with profiling.file(name):
+            return save_file(*args, **get_save_options(argv))
+
+    return pipeline(names, read_file, process, write, prefetch=argv.prefetch)
 
 
 def main(args=None) -> None:
+    args = sys.argv[1:] if args is None else args
+    if args[:1] == ['serve']:
+        from wim import serve  # noqa: PLC0415
+
+        serve.main(args[1:])
+        return
+
     argv = get_args(args)
-    for name in argv.filename:
-        proc_file(name, argv)
+    names: Iterable[str] = iter_inputs(argv)
+
+    argv.profile = argv.profile or bool(argv.profile_output)
+    if argv.profile:
+        profiling.enable()
+
+    # The dry run doesn't quantize, so it doesn't need the palette.
+    if not argv.dry_run:
+        try:
+            names = set_palette(argv, names)
+        except OSError as e:
+            sys.exit(f'Error loading palette {argv.palette}: {e}')
+        except ValueError as e:
+            sys.exit(f'Error building palette from --palette-sample {argv.palette_sample}: {e}')
+
+    # Stdout is reserved for the image data, messages are written to stderr.
+    if argv.stdout:
+        name = argv.filename[0]
+        _, output, error = capture(proc_stream, name, argv, sys.stdout.buffer)
+        print(output, end='', file=sys.stderr)
+        if argv.profile:
+            print(profiling.format_table(profiling.summarize(profiling.drain())), file=sys.stderr)
+        if error:
+            print(f'Error processing {name}: {error}', file=sys.stderr)
+            sys.exit(1)
+        return
+
+    # Skip files whose source and options are unchanged since the last incremental run.
+    entries = {}
+    manifest: dict = {}
+    skipped = 0
+    if argv.incremental:
+        manifest = load_manifest(argv.manifest)
+        fingerprint = get_fingerprint(argv)
+
+        def changed(names: Iterable[str]) -> Iterator[str]:
+            nonlocal skipped
+            for name in names:
+                src = Path(name)
+                dst = get_dst(src, argparse.Namespace(**vars(argv)), mkdir=False)
+                entry = get_entry(src, fingerprint)
+                if is_current(manifest, dst, entry):
+                    print(f'Skipping unchanged image: {name}')
+                    skipped += 1
+                else:
+                    entries[name] = (str(dst), entry)
+                    yield name
+
+        names = changed(names)
+
+    # Discovered files are processed as they are found, their number is not known in advance.
+    jobs = argv.jobs if argv.recursive or argv.files_from else min(argv.jobs, len(argv.filename))
+
+    if argv.dry_run:
+        from wim import plan  # noqa: PLC0415
+
+        throughput = plan.load_throughput(argv.calibration) if argv.calibration else plan.THROUGHPUT
+        totals = plan.run(names, argv, jobs, throughput)
+        print(plan.format_totals(totals))
+        if skipped:
+            print(f'Skipped {skipped} unchanged files.')
+        return
+    if jobs > 1:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        results = run_pool(names, argv, executor, jobs)
+    else:
+        executor = None
+        results = run_pipeline(names, argv)
+
+    # Results are reported in input order, regardless of which worker finishes first.
+    processed = 0
+    errors = []
+    try:
+        for name, dsts, output, error in results:
+            processed += 1
+            print(output, end='')
+            if error:
+                print(f'Error processing {name}: {error}', file=sys.stderr)
+                errors.append(name)
+                entries.pop(name, None)
+            elif name in entries:
+                key, entry = entries.pop(name)
+                manifest[key] = {**entry, 'outputs': [str(dst) for dst in dsts]}
+    finally:
+        if executor:
+            executor.shutdown()
+        if argv.incremental:
+            save_manifest(argv.manifest, manifest)
+
+    print(
+        f'Processed {processed + skipped} files: {processed - len(errors)} succeeded, '
+        f'{skipped} skipped, {len(errors)} failed.'
+    )
+
+    if argv.profile:
+        records = profiling.drain()
+        print(profiling.format_table(profiling.summarize(records)))
+        if argv.profile_output:
+            profiling.write_trace(argv.profile_output, records)
+        profiling.disable()
+    if errors:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+"""
+This module finds input images in directory trees and file lists without building the full list first.
+
+Names are yielded as they are found, so processing starts with the first file and memory use does not grow
+with the number of files. Directories are read with os.scandir, entries of each directory in name order.
+
+Functions:
+    - is_input: Check whether a path has an image extension, matches the filters and is not a wim output.
+    - read_names: Yield file names read line by line from a file or stdin.
+    - scan: Yield image files in a directory tree.
+"""
+
+import fnmatch
+import os
+import re
+import sys
+from collections.abc import Callable, Iterable, Iterator
+
+from wim.image import IMAGE_FORMATS
+
+STDIN = '-'
+
+
+def _matches(path: str, patterns: Iterable[str]) -> bool:
+    name = os.path.basename(path)
+    return any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def is_input(
+    path: str,
+    include: Iterable[str] = (),
+    exclude: Iterable[str] = (),
+    output_label: str | None = None,
+) -> bool:
+    """
+    Check whether a path has an image extension, matches the filters and is not a wim output.
+
+    Args:
+        path: File path, the patterns are matched against it and against the file name
+        include: Glob patterns, if given the path or file name must match one of them
+        exclude: Glob patterns, the path and file name must not match any of them
+        output_label: Label wim appends to output file names, files ending with it are skipped
+
+    Returns:
+        bool: True if the file should be processed
+    """
+    stem, ext = os.path.splitext(os.path.basename(path))
+    if ext.lstrip('.').lower() not in IMAGE_FORMATS:
+        return False
+    # Outputs are named <stem><label>.<format> or <stem><label>-<width>w.<format> for multiple sizes.
+    if output_label and re.search(f'{re.escape(output_label)}(-\\d+w)?$', stem):
+        return False
+    if include and not _matches(path, include):
+        return False
+    return not _matches(path, exclude)
+
+
+def read_names(path: str) -> Iterator[str]:
+    """
+    Yield file names read line by line from a file or from stdin if path is -, skipping empty lines.
+
+    Names are decoded like names returned by os.listdir, so names that aren't valid in the file system encoding,
+    e.g., written by find, reach open unchanged.
+    """
+    f = sys.stdin.buffer if path == STDIN else open(path, 'rb')  # noqa: SIM115
+    try:
+        for line in f:
+            name = os.fsdecode(line.rstrip(b'\r\n'))
+            if name.strip():
+                yield name
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+
+def scan(directory: str, onerror: Callable[[OSError], None] | None = None, **filters) -> Iterator[str]:
+    """
+    Yield image files in a directory tree, depth first with the entries of each directory in name order.
+
+    Filter patterns are matched against paths relative to directory. Symbolic links to directories are not
+    followed, so link cycles can't cause endless recursion. Directories that can't be read are skipped, like
+    in os.walk the error is passed to onerror if given.
+
+    Args:
+        directory: Root of the directory tree
+        onerror: Function called with the OSError of a directory that can't be read
+        **filters: include, exclude and output_label, see is_input
+    """
+    yield from _scan(directory, '', onerror, filters)
+
+
+def _scan(directory: str, prefix: str, onerror: Callable[[OSError], None] | None, filters: dict) -> Iterator[str]:
+    # prefix is the path of directory relative to the root, os.path.relpath is too slow for large trees.
+    try:
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError as e:
+        if onerror is not None:
+            onerror(e)
+        return
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from _scan(entry.path, f'{prefix}{entry.name}{os.sep}', onerror, filters)
+        elif entry.is_file() and is_input(f'{prefix}{entry.name}', **filters):
+            yield entry.path
@@ -1,19 +1,47 @@
-from PIL import Image, ImageDraw, ImageFont
+import io
+import math
+import os
+import zlib
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import NamedTuple
+
+from PIL import ExifTags, Image, ImageDraw, ImageFont, ImageOps
+
+from wim import profiling
 
 """
 This module provides utility functions for image manipulation using the Python Imaging Library (PIL).
 It includes functions for adding overlays, text, and metadata extraction, as well as image format
 handling and quality optimization.
 
+Classes:
+    - Pipeline: Processing steps compiled once from typed options and applied to many images.
+
 Functions:
     - add_image: Blend an overlay image onto a base image with customizable position, scale, and opacity.
     - add_text: Add text with a semi-transparent background to an image.
+    - apply_palette: Map an image to the colors of a shared palette.
+    - build_palette: Build a palette shared by several images from reduced copies of them.
     - calculate_position: Calculate the position for placing an overlay on a base image.
+    - draft: Configure the decoder to load a reduced-size version of an image that will be scaled down.
+    - encode: Encode an image in memory.
+    - encode_max_bytes: Encode an image in memory, searching for settings that keep it within a file size.
+    - encode_smallest: Encode an image in memory with several options in parallel and keep the smallest.
     - ensure_rgba: Ensure an image is in RGBA mode.
+    - get_effort: Generate encoder options for an effort preset and format.
+    - get_orientation: Return the EXIF orientation of an image without decoding it.
     - get_metadata: Extract metadata from an image, including EXIF, ICC profile, and other common metadata.
     - get_quality: Generate quality and optimization options for saving images in specific formats.
     - load_font: Load a TrueType font with fallback to the default system font.
+    - load_palette: Load a shared palette from an image file, cached per process.
+    - prepare_overlay: Load, scale and apply opacity to an overlay image, cached per process.
+    - quantize: Quantize an image, or map it to a shared palette.
+    - render_text: Render text into a reusable tile, cached per process.
     - set_background: Convert an RGBA image to RGB mode with a black background.
+    - thumbnail_size: Return the size Image.thumbnail scales an image to.
 
 Constants:
     - IMAGE_FORMATS: Supported image formats for processing.
@@ -21,10 +49,28 @@ Constants:
     - QUANTIZE_FORMATS: Formats that support quantization.
     - OPTIMIZE_FORMATS: Formats that support optimization.
     - RGBA_FORMATS: Formats that support RGBA mode.
+    - POSITIONS: Positions of text and overlays on the base image.
     - MODE: Default image mode ('RGBA').
     - BLACK: Black color in RGBA mode.
     - WHITE: White color in RGBA mode.
     - FULL_OPACITY: Maximum opacity value (255).
+    - MAX_QUALITY: Maximum output quality (100).
+    - MAX_COLORS: Maximum number of colors of quantized images (256).
+    - OVERLAY_CACHE_SIZE: Maximum number of prepared overlays kept in memory.
+    - FONT_CACHE_SIZE: Maximum number of loaded fonts kept in memory.
+    - TEXT_CACHE_SIZE: Maximum number of rendered text tiles kept in memory.
+    - PALETTE_CACHE_SIZE: Maximum number of loaded palettes kept in memory.
+    - PALETTE_SAMPLE_SIZE: Maximum size of the reduced copies a shared palette is built from.
+    - QUANTIZE_METHODS: Pillow quantization methods by name.
+    - DITHERS: Pillow dithering methods by name, used when mapping images to a shared palette.
+    - TRANSPARENT_ALPHA: Pixels with less opacity become transparent in palette images.
+    - REDUCING_GAP: Minimum ratio between the size of a reduced-size decode and the target size.
+    - BAND_HEIGHT: Rows per horizontal band when an image is processed by several threads.
+    - MAX_BYTES_TRIES: Maximum number of encodes when searching for settings within a file size.
+    - MAX_BYTES_QUALITY: Highest quality tried when searching for settings within a file size.
+    - EFFORTS: Encoder effort presets, from fastest to smallest output.
+    - EFFORT_OPTIONS: Encoder options per effort preset and format.
+    - PNG_VARIANTS: PNG encoder options tried in parallel with the max effort preset.
 """
 
 IMAGE_FORMATS = {'bmp', 'gif', 'ico', 'jpeg', 'jpg', 'png', 'webp'}
@@ -32,20 +78,84 @@ QUALITY_FORMATS = {'jpeg', 'jpg', 'webp'}
 QUANTIZE_FORMATS = {'png', 'gif'}
 OPTIMIZE_FORMATS = {'png', 'gif'}
 RGBA_FORMATS = {'png', 'webp', 'gif', 'ico'}
+POSITIONS = ('top-left', 'top-right', 'bottom-left', 'bottom-right', 'center')
 
 MODE = 'RGBA'
 BLACK = (0, 0, 0, 255)
 WHITE = (255, 255, 255, 255)
 FULL_OPACITY = 255
+MAX_QUALITY = 100
+MAX_COLORS = 256
+OVERLAY_CACHE_SIZE = 32
+FONT_CACHE_SIZE = 16
+TEXT_CACHE_SIZE = 32
+PALETTE_CACHE_SIZE = 8
+PALETTE_SAMPLE_SIZE = (256, 256)
+QUANTIZE_METHODS = {
+    'mediancut': Image.Quantize.MEDIANCUT,
+    'maxcoverage': Image.Quantize.MAXCOVERAGE,
+    'fastoctree': Image.Quantize.FASTOCTREE,
+    'libimagequant': Image.Quantize.LIBIMAGEQUANT,
+}
+DITHERS = {'none': Image.Dither.NONE, 'floydsteinberg': Image.Dither.FLOYDSTEINBERG}
+# Pixels with less opacity become transparent in palette images, like Pillow does for GIF.
+TRANSPARENT_ALPHA = 128
+TRANSPARENT_LUT = [255] * TRANSPARENT_ALPHA + [0] * (256 - TRANSPARENT_ALPHA)
+REDUCING_GAP = 2.0
+BAND_HEIGHT = 256
+MAX_BYTES_TRIES = 8
+MAX_BYTES_QUALITY = 95
+EFFORTS = ('fast', 'balanced', 'max')
+EFFORT_OPTIONS: dict[str, dict[str, dict[str, bool | int]]] = {
+    'fast': {
+        'gif': {'optimize': False},
+        'jpeg': {'optimize': False, 'progressive': False},
+        'png': {'optimize': False, 'compress_level': 1},
+        'webp': {'method': 0},
+    },
+    'balanced': {
+        'gif': {'optimize': True},
+        'jpeg': {'optimize': True, 'progressive': False},
+        'png': {'optimize': False, 'compress_level': 6},
+        'webp': {'method': 4},
+    },
+    'max': {
+        'gif': {'optimize': True},
+        'jpeg': {'optimize': True, 'progressive': True},
+        'png': {'optimize': True, 'compress_level': 9},
+        'webp': {'method': 6},
+    },
+}
+# Pillow's optimize flag and the zlib strategy each win on different images, a lower level can even beat 9.
+PNG_VARIANTS = (
+    {'optimize': True},
+    {'optimize': False, 'compress_type': zlib.Z_FILTERED},
+    {'optimize': False, 'compress_type': zlib.Z_RLE},
+    {'optimize': False, 'compress_level': 6},
+)
+# EXIF orientations that rotate the image by 90 or 270 degrees
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+class TextTile(NamedTuple):
+    """Rendered text and the geometry needed to place it with its background box."""
+
+    image: Image.Image  # Text layer in RGBA mode
+    offset: tuple[int, int]  # Position of the text layer relative to the background box
+    size: tuple[int, int]  # Width and height of the background box
 
 
 def add_image(
     img: Image.Image,
-    overlay_path: str,
+    overlay: str | Image.Image,
     position: str = 'bottom-right',
     padding: int = 0,
     scale: tuple[int, int] | None = None,
     opacity: int = FULL_OPACITY,
+    *,
+    keep_rgb: bool = False,
+    inplace: bool = False,
+    threads: int = 1,
 ):
     """
     Blend an overlay image onto a base image at a specified position with optional scaling, padding, and opacity.
@@ -54,7 +164,8 @@ def add_image(
 
     Args:
         img (PIL.Image.Image): The base image onto which the overlay will be added.
-        overlay_path (str): The file path to the overlay image.
+        overlay (str or PIL.Image.Image): The file path to the overlay image or an overlay image,
+            e.g., one returned by prepare_overlay. File paths are loaded via the prepare_overlay cache.
         position (str, optional): The position of the overlay on the base image.
             Options are 'top-left', 'top-right', 'bottom-left', 'bottom-right', and 'center'.
             Defaults to 'bottom-right'.
@@ -64,38 +175,36 @@ def add_image(
             If None, the overlay retains its original size. Defaults to None.
         opacity (int, optional): The opacity level of the overlay, ranging from 0 (completely transparent)
             to 255 (fully opaque). Defaults to FULL_OPACITY (255).
+        keep_rgb (bool, optional): Blend into an RGB base image without converting it to RGBA, for outputs
+            without alpha channel. The pixels are identical to set_background applied to the RGBA result.
+            Defaults to False.
+        inplace (bool, optional): Blend into the base image itself instead of a copy if no conversion is needed,
+            which saves a full-size copy of large images. Defaults to False.
+        threads (int, optional): Number of threads that blend horizontal bands of the covered area and apply
+            the opacity, the result is identical to a single thread. Defaults to 1.
 
     Returns:
-        PIL.Image.Image: A new image with the overlay blended onto the base image.
+        PIL.Image.Image: A new image with the overlay blended onto the base image, or the base image if inplace
+            is set and it wasn't converted.
     """
 
-    # Load and prepare overlay image
-    overlay_img = ensure_rgba(Image.open(overlay_path))
-
-    # Scale if requested
-    if scale:
-        overlay_img.thumbnail(scale)
-
-    # Adjust opacity if needed
-    if opacity < FULL_OPACITY:
-        # Create a copy to avoid modifying the original
-        overlay_img = overlay_img.copy()
-        # Get alpha channel and adjust it
-        alpha = overlay_img.getchannel('A')
-        alpha = alpha.point(lambda x: int(x * opacity / FULL_OPACITY))
-        overlay_img.putalpha(alpha)
+    if not isinstance(overlay, Image.Image):
+        overlay_img = prepare_overlay(overlay, scale, opacity, threads)
+    elif scale or opacity < FULL_OPACITY:
+        # Work on a copy to avoid modifying the original
+        overlay_img = _prepare_overlay_image(overlay.convert(MODE), scale, opacity, threads)
+    else:
+        overlay_img = ensure_rgba(overlay)
 
-    # Create a transparent canvas the same size as the base image
-    canvas = Image.new(MODE, img.size, (0, 0, 0, 0))
+    # Transparent layer with the overlay pasted through its own alpha channel
+    layer = Image.new(MODE, overlay_img.size, (0, 0, 0, 0))
+    layer.paste(overlay_img, (0, 0), overlay_img)
 
     # Calculate position
     x_pos, y_pos = calculate_position(img.size, overlay_img.size, position, padding)
 
-    # Paste overlay onto canvas
-    canvas.paste(overlay_img, (x_pos, y_pos), overlay_img)
-
-    # Composite with base image
-    return Image.alpha_composite(ensure_rgba(img), canvas)
+    # Composite with base image, only the area covered by the overlay is blended
+    return _composite_at(_base_copy(img, keep_rgb=keep_rgb, inplace=inplace), layer, (x_pos, y_pos), threads)
 
 
 def add_text(
@@ -106,6 +215,10 @@ def add_text(
     bg_alpha: int = 32,
     position: str = 'bottom-right',
     padding: int = 0,
+    *,
+    keep_rgb: bool = False,
+    inplace: bool = False,
+    threads: int = 1,
 ) -> Image.Image:
     """
     Add text with semi-transparent background to an image.
@@ -118,47 +231,120 @@ def add_text(
         bg_alpha: Background transparency 0-255 (0=transparent, 255=opaque)
         position: One of 'top-left', 'top-right', 'bottom-left', 'bottom-right', 'center'
         padding: Padding from image edges in pixels
+        keep_rgb: Blend into an RGB base image without converting it to RGBA, see add_image
+        inplace: Blend into the base image itself instead of a copy if no conversion is needed
+        threads: Number of threads that blend horizontal bands of the text box, see add_image
 
     Returns:
-        Image with text overlay in RGBA mode
+        Image with text overlay in RGBA mode, or in RGB mode if keep_rgb is set and the image is in RGB mode
 
     Raises:
         ValueError: If bg_alpha not in range 0-255
     """
 
-    font = load_font(font_name, font_size)
-    bbox = font.getbbox(text)
-    text_width = bbox[2] - bbox[0]
-    text_height = bbox[3] - bbox[1]
-    text_img_height = int(text_height * 1.5)
-    text_img_width = int(text_width * 1.1)
+    tile = render_text(font_name, font_size, text)
+    return _add_text_tile(img, tile, bg_alpha, position, padding, keep_rgb=keep_rgb, inplace=inplace, threads=threads)
 
-    # Create a transparent overlay the same size as the base image
-    base_overlay = Image.new(MODE, img.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(base_overlay, MODE)
+
+def _add_text_tile(
+    img: Image.Image,
+    tile: TextTile,
+    bg_alpha: int = 32,
+    position: str = 'bottom-right',
+    padding: int = 0,
+    *,
+    keep_rgb: bool = False,
+    inplace: bool = False,
+    threads: int = 1,
+) -> Image.Image:
+    """Blend a rendered text tile with its semi-transparent background box onto an image, see add_text."""
+
+    text_img_width, text_img_height = tile.size
 
     # Calculate position
-    x_pos, y_pos = calculate_position(img.size, (text_img_width, text_img_height), position, padding)
+    x_pos, y_pos = calculate_position(img.size, tile.size, position, padding)
 
-    # Draw semi-transparent background rectangle
+    # Composite the semi-transparent background first, the box includes its end coordinates
     bg_color = (0, 0, 0, bg_alpha)
-    draw.rectangle([(x_pos, y_pos), (x_pos + text_img_width, y_pos + text_img_height)], fill=bg_color)
+    base_overlay = Image.new(MODE, (text_img_width + 1, text_img_height + 1), bg_color)
+    result = _composite_at(_base_copy(img, keep_rgb=keep_rgb, inplace=inplace), base_overlay, (x_pos, y_pos), threads)
+
+    # Composite the fully opaque text
+    return _composite_at(result, tile.image, (x_pos + tile.offset[0], y_pos + tile.offset[1]), threads)
+
 
-    # Composite the semi-transparent background first
-    base_layer = Image.alpha_composite(ensure_rgba(img), base_overlay)
+def apply_palette(img: Image.Image, palette: Image.Image, dither: Image.Dither = Image.Dither.NONE) -> Image.Image:
+    """
+    Map an image to the colors of a shared palette, without building a palette for the image.
+
+    Pixels with less than half opacity get the transparent entry of the palette, if it has one. The transparent
+    entry is not used for opaque pixels, even if its color is the closest.
+
+    Args:
+        img: PIL Image object
+        palette: Palette image returned by build_palette or load_palette
+        dither: Dithering applied when mapping the colors
+
+    Returns:
+        PIL Image object in P mode with the colors of the palette
+    """
+    entries = palette.getpalette() or []
+    transparency = palette.info.get('transparency')
+    colors = palette
+    if transparency is not None:
+        # The transparent entry is the last one, see _palette_image.
+        colors = _palette_image(entries[:-3])
+
+    out = img.convert('RGB').quantize(palette=colors, dither=dither)
+    out.putpalette(entries)
+    if transparency is not None and img.has_transparency_data:
+        alpha = ensure_rgba(img).getchannel('A')
+        out.paste(transparency, mask=alpha.point(TRANSPARENT_LUT))
+        out.info['transparency'] = transparency
+    return out
+
+
+def build_palette(
+    images: Iterable[Image.Image], colors: int = 256, method: Image.Quantize | None = None
+) -> Image.Image:
+    """
+    Build a palette shared by several images from reduced copies of them.
 
-    # Now draw the fully opaque text on a new overlay
-    text_overlay = Image.new(MODE, img.size, (0, 0, 0, 0))
-    text_draw = ImageDraw.Draw(text_overlay, MODE)
+    The copies are at most PALETTE_SAMPLE_SIZE, placed side by side and quantized together, so any method works,
+    also for images with alpha channel. If an image has transparent pixels, one of the colors is reserved as
+    transparent entry.
 
-    # Calculate centered text position
-    text_x = x_pos + (text_img_width - text_width) / 2
+    Args:
+        images: Images to sample, each one is reduced before the next one is requested
+        colors: Number of palette entries, including the transparent entry
+        method: Quantization method, see QUANTIZE_METHODS, None for Pillow's default
 
-    # Draw text with full opacity (alpha = 255)
-    text_draw.text((text_x, y_pos), text, WHITE, font=font)
+    Returns:
+        PIL Image object in P mode that holds the palette, see apply_palette
 
-    # Composite the text overlay
-    return Image.alpha_composite(base_layer, text_overlay)
+    Raises:
+        ValueError: If images is empty
+    """
+    samples = []
+    transparency = False
+    for img in images:
+        sample = img.resize(thumbnail_size(img.size, PALETTE_SAMPLE_SIZE))
+        if sample.has_transparency_data:
+            sample = ensure_rgba(sample)
+            transparency = transparency or sample.getchannel('A').point(TRANSPARENT_LUT).getbbox() is not None
+        samples.append(sample.convert('RGB'))
+    if not samples:
+        msg = 'no images to build a palette from'
+        raise ValueError(msg)
+
+    sheet = Image.new('RGB', (sum(sample.width for sample in samples), max(sample.height for sample in samples)))
+    x = 0
+    for sample in samples:
+        sheet.paste(sample, (x, 0))
+        x += sample.width
+
+    quantized = sheet.quantize(colors=max(colors - transparency, 1), method=method)
+    return _palette_image(quantized.getpalette() or [], transparent=transparency)
 
 
 def calculate_position(base_size: tuple, overlay_size: tuple, position: str, padding: int) -> tuple:
@@ -196,12 +382,168 @@ def calculate_position(base_size: tuple, overlay_size: tuple, position: str, pad
     return positions.get(position, positions['bottom-right'])
 
 
+def draft(img: Image.Image, size: tuple[int, int], reducing_gap: float = REDUCING_GAP) -> Image.Image:
+    """
+    Configure the decoder to load a reduced-size version of an image that will be scaled down to size.
+
+    This uses DCT scaling for JPEG images and has no effect for formats that don't support reduced-size
+    decoding or images that are already loaded. The decoded image is at least reducing_gap times as large
+    as size, which gives the same quality as Image.thumbnail. Call this before ImageOps.exif_transpose,
+    size is given in the orientation after transposing.
+
+    Args:
+        img: PIL Image object that has not been loaded yet
+        size: Maximum width and height the image will be scaled down to
+        reducing_gap: Minimum ratio between the decoded size and size
+
+    Returns:
+        The same image object
+    """
+    width, height = size
+    if get_orientation(img) in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+
+    img.draft(None, (int(width * reducing_gap), int(height * reducing_gap)))
+    return img
+
+
+def encode(img: Image.Image, img_format: str, effort: str | None = None, **save_kwargs) -> bytes:
+    """
+    Encode an image in memory, img_format is a file extension like 'jpg' or 'png'.
+
+    With the max effort preset PNG images are encoded with each of PNG_VARIANTS and the smallest is kept.
+    """
+    if effort == 'max' and img_format == 'png':
+        return encode_smallest(img, img_format, list(PNG_VARIANTS), save_kwargs)
+
+    buf = io.BytesIO()
+    img.save(buf, format=Image.registered_extensions()[f'.{img_format}'], **save_kwargs)
+    return buf.getvalue()
+
+
+def encode_max_bytes(
+    img: Image.Image,
+    img_format: str,
+    max_bytes: int,
+    save_kwargs: dict | None = None,
+    tries: int = MAX_BYTES_TRIES,
+    effort: str | None = None,
+    colors: int | None = None,
+    method: Image.Quantize | None = None,
+) -> bytes:
+    """
+    Encode an image in memory, searching for settings that keep the encoded size within max_bytes.
+
+    For JPEG and WebP the highest quality that fits is searched, starting from the quality in save_kwargs
+    or MAX_BYTES_QUALITY. PNG and GIF images are encoded losslessly if that fits, otherwise the highest number
+    of quantization colors that fits is searched. If colors is set, they are always quantized with at most
+    colors. Other formats and palette images are encoded once.
+
+    Args:
+        img: PIL Image object
+        img_format: Output format as file extension, e.g., 'jpg' or 'png'
+        max_bytes: Maximum size of the encoded image in bytes
+        save_kwargs: Options passed to Image.save, e.g., metadata and options returned by get_quality
+        tries: Maximum number of encodes
+        effort: Encoder effort preset, see encode
+        colors: Maximum number of quantization colors for PNG and GIF, e.g., of the --quantize option
+        method: Quantization method, None for Pillow's default
+
+    Returns:
+        bytes: Largest encode that fits or, if none fits, the smallest encode tried
+    """
+    save_kwargs = save_kwargs or {}
+
+    if img_format in QUALITY_FORMATS:
+        quality = save_kwargs.get('quality', MAX_BYTES_QUALITY)
+        return _search_max_bytes(
+            lambda value: encode(img, img_format, effort, **{**save_kwargs, 'quality': value}),
+            1,
+            quality,
+            max_bytes,
+            tries,
+        )
+
+    def encode_at(value: int) -> bytes:
+        return encode(img.quantize(colors=value, method=method), img_format, effort, **save_kwargs)
+
+    if colors and img_format in QUANTIZE_FORMATS and img.mode != 'P':
+        return _search_max_bytes(encode_at, min(2, colors), colors, max_bytes, tries)
+
+    data = encode(img, img_format, effort, **save_kwargs)
+    if len(data) <= max_bytes or img_format not in QUANTIZE_FORMATS or img.mode == 'P':
+        return data
+
+    smaller = _search_max_bytes(encode_at, 2, MAX_COLORS, max_bytes, tries - 1)
+    return min(data, smaller, key=len)
+
+
+def encode_smallest(img: Image.Image, img_format: str, variants: list[dict], save_kwargs: dict | None = None) -> bytes:
+    """
+    Encode an image in memory once per variant in parallel and return the smallest result.
+
+    Pillow releases the GIL while encoding, so the variants are encoded concurrently. Each encode uses its own
+    copy of the image, because Image.save stores the options on the image.
+
+    Args:
+        img: PIL Image object
+        img_format: Output format as file extension, e.g., 'png'
+        variants: Options that differ between the encodes, merged into save_kwargs
+        save_kwargs: Options shared by all encodes
+
+    Returns:
+        bytes: Smallest encoded image
+    """
+    save_kwargs = save_kwargs or {}
+
+    def run(variant: dict) -> bytes:
+        return encode(img.copy(), img_format, **{**save_kwargs, **variant})
+
+    with ThreadPoolExecutor(len(variants), 'wim-encode') as executor:
+        return min(executor.map(run, variants), key=len)
+
+
+def _search_max_bytes(encode_at: Callable[[int], bytes], low: int, high: int, max_bytes: int, tries: int) -> bytes:
+    """Binary search the highest value between low and high whose encode fits, the size grows with the value."""
+
+    best, smallest = None, None
+    value = high
+    while low <= high and tries > 0:
+        data = encode_at(value)
+        tries -= 1
+        if len(data) <= max_bytes:
+            best = data
+            low = value + 1
+        else:
+            high = value - 1
+        if smallest is None or len(data) < len(smallest):
+            smallest = data
+        value = (low + high) // 2
+
+    return best or smallest or encode_at(low)
+
+
 def ensure_rgba(img: Image.Image) -> Image.Image:
     """Ensure the image is in RGBA mode."""
 
     return img if img.mode == MODE else img.convert(MODE)
 
 
+def get_effort(effort: str, img_format: str) -> dict:
+    """
+    Generate encoder options for an effort preset.
+
+    Args:
+        effort: One of EFFORTS, faster presets produce larger files
+        img_format: Output format as file extension, e.g., 'jpg' or 'png'
+
+    Returns:
+        dict: Options passed to Image.save, empty for formats without encoder options
+    """
+    img_format = 'jpeg' if img_format == 'jpg' else img_format
+    return dict(EFFORT_OPTIONS[effort].get(img_format, {}))
+
+
 def get_metadata(img: Image.Image) -> dict:
     """Extract metadata from an image.
 
@@ -242,6 +584,18 @@ def get_metadata(img: Image.Image) -> dict:
     return metadata
 
 
+def get_orientation(img: Image.Image) -> int:
+    """
+    Return the EXIF orientation of an image without decoding it, 1 if the image has no orientation.
+
+    Only EXIF data found while reading the header is considered, Image.getexif loads PNG images to find EXIF
+    data that is stored after the image data.
+    """
+    if 'exif' not in img.info:
+        return 1
+    return img.getexif().get(ExifTags.Base.Orientation, 1)
+
+
 def get_quality(quality: int, img_format: str) -> dict:
     """
     Generate image processing options based on the provided quality and format.
@@ -271,10 +625,13 @@ def get_quality(quality: int, img_format: str) -> dict:
     return options
 
 
+@lru_cache(maxsize=FONT_CACHE_SIZE)
 def load_font(font_name: str | None, font_size: int) -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
     """
     Load a TrueType font with fallback to default font.
 
+    Fonts are cached by name and size, so they are loaded and reported only once per process.
+
     Args:
         font_name: Name of or path to TrueType font file or None
         font_size: Size of the font (ignored for default font)
@@ -294,16 +651,627 @@ def load_font(font_name: str | None, font_size: int) -> ImageFont.FreeTypeFont |
         return ImageFont.load_default()
 
 
-def set_background(img: Image.Image) -> Image.Image:
+def load_palette(path: str, colors: int = 256, method: Image.Quantize | None = None) -> Image.Image:
+    """
+    Load a shared palette from an image file, see apply_palette.
+
+    The colors of P mode images are used as they are. Images in other modes are quantized to colors with
+    build_palette. Palettes are cached by path, file modification time, colors and method.
+
+    Args:
+        path: Path to the palette image
+        colors: Number of palette entries for images that aren't in P mode
+        method: Quantization method for images that aren't in P mode
+
+    Returns:
+        PIL Image object in P mode that holds the palette
+    """
+    mtime = os.stat(path).st_mtime_ns
+    return _load_palette(path, mtime, colors, method)
+
+
+@lru_cache(maxsize=PALETTE_CACHE_SIZE)
+def _load_palette(
+    path: str,
+    mtime: int,  # noqa: ARG001
+    colors: int,
+    method: Image.Quantize | None,
+) -> Image.Image:
+    with Image.open(path) as img:
+        if img.mode != 'P':
+            return build_palette([img], colors, method)
+
+        entries = img.getpalette() or []
+        transparency = img.info.get('transparency')
+        if isinstance(transparency, int) and transparency < len(entries) // 3:
+            # Move the transparent entry to the end, see _palette_image.
+            color = slice(transparency * 3, transparency * 3 + 3)
+            return _palette_image(entries[: color.start] + entries[color.stop :], transparent=True)
+        return _palette_image(entries)
+
+
+def _palette_image(entries: list[int], *, transparent: bool = False) -> Image.Image:
+    """Create a 1x1 image that holds a palette, a transparent entry is appended as last entry."""
+
+    palette = Image.new('P', (1, 1))
+    if transparent:
+        entries = [*entries, 0, 0, 0]
+        palette.info['transparency'] = len(entries) // 3 - 1
+    palette.putpalette(entries)
+    return palette
+
+
+def prepare_overlay(
+    overlay_path: str, scale: tuple[int, int] | None = None, opacity: int = FULL_OPACITY, threads: int = 1
+) -> Image.Image:
+    """
+    Load an overlay image and apply scaling and opacity.
+
+    Prepared overlays are cached by path, file modification time, scale and opacity, so the same
+    watermark is only decoded once per process. The returned image is shared and must not be modified.
+
+    Args:
+        overlay_path: Path to the overlay image
+        scale: Maximum size (width, height) of the overlay or None to keep the original size
+        opacity: Opacity of the overlay 0-255
+        threads: Number of threads that apply the opacity to horizontal bands of the overlay
+
+    Returns:
+        Overlay image in RGBA mode
+    """
+    mtime = os.stat(overlay_path).st_mtime_ns
+    return _load_overlay(overlay_path, mtime, tuple(scale) if scale else None, opacity, threads)
+
+
+def quantize(
+    img: Image.Image,
+    colors: int = 256,
+    palette: Image.Image | None = None,
+    method: Image.Quantize | None = None,
+    dither: Image.Dither = Image.Dither.NONE,
+) -> Image.Image:
+    """
+    Quantize an image to colors, or map it to a shared palette if one is given.
+
+    Mapping to a shared palette is much faster than building a palette per image and all images get the same
+    colors. Dithering only applies to the mapping, Pillow doesn't dither when it builds a palette.
+
+    Args:
+        img: PIL Image object
+        colors: Number of colors if no palette is given
+        palette: Palette image returned by build_palette or load_palette
+        method: Quantization method if no palette is given, None for Pillow's default
+        dither: Dithering applied when mapping to the palette
+
+    Returns:
+        PIL Image object in P mode
+    """
+    if palette is not None:
+        return apply_palette(img, palette, dither)
+    return img.quantize(colors=colors, method=method)
+
+
+def _composite_at(img: Image.Image, layer: Image.Image, position: tuple[int, int], threads: int = 1) -> Image.Image:
+    """
+    Alpha composite a layer onto an RGBA or RGB image in place, blending only the area the layer covers.
+
+    The result is identical to compositing a full-size transparent canvas with the layer pasted at position.
+    For RGB images only the covered area is converted to RGBA, which is opaque, so the composite is too.
+    Each pixel is blended independently, so horizontal bands of the area can be blended by several threads.
+    """
+    x_pos, y_pos = position
+    left, top = max(x_pos, 0), max(y_pos, 0)
+    right, bottom = min(x_pos + layer.width, img.width), min(y_pos + layer.height, img.height)
+
+    def blend(band_top: int, band_bottom: int) -> None:
+        source = (left - x_pos, band_top - y_pos, right - x_pos, band_bottom - y_pos)
+        if img.mode == MODE:
+            img.alpha_composite(layer, (left, band_top), source)
+        else:
+            region = img.crop((left, band_top, right, band_bottom)).convert(MODE)
+            region.alpha_composite(layer, (0, 0), source)
+            img.paste(region.convert(img.mode), (left, band_top))
+
+    if left < right and top < bottom:
+        _run_bands(blend, top, bottom, threads)
+
+    return img
+
+
+@lru_cache(maxsize=OVERLAY_CACHE_SIZE)
+def _load_overlay(
+    overlay_path: str,
+    mtime: int,  # noqa: ARG001
+    scale: tuple[int, int] | None,
+    opacity: int,
+    threads: int = 1,
+) -> Image.Image:
+    with Image.open(overlay_path) as overlay_img:
+        return _prepare_overlay_image(overlay_img.convert(MODE), scale, opacity, threads)
+
+
+def _prepare_overlay_image(
+    overlay_img: Image.Image, scale: tuple[int, int] | None, opacity: int, threads: int = 1
+) -> Image.Image:
+    """Scale and adjust opacity of an RGBA overlay image in place."""
+
+    # Scale if requested
+    if scale:
+        overlay_img.thumbnail(scale)
+
+    # Adjust opacity if needed
+    if opacity < FULL_OPACITY:
+        alpha = overlay_img.getchannel('A')
+        lut = [int(x * opacity / FULL_OPACITY) for x in range(256)]
+
+        def apply(top: int, bottom: int) -> None:
+            box = (0, top, alpha.width, bottom)
+            alpha.paste(alpha.crop(box).point(lut), box)
+
+        if threads > 1:
+            _run_bands(apply, 0, alpha.height, threads)
+        else:
+            alpha = alpha.point(lut)
+        overlay_img.putalpha(alpha)
+
+    return overlay_img
+
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def render_text(font_name: str | None, font_size: int, text: str) -> TextTile:
+    """
+    Render text in white on a transparent tile that is only as large as the text.
+
+    Tiles are cached by font and text, so the same caption is measured and rasterized only once per process.
+    The returned tile is shared and must not be modified.
+
+    Args:
+        font_name: Font name or path to .ttf file (None for default)
+        font_size: Font size in pixels
+        text: Text to render
+
+    Returns:
+        TextTile with the text layer, its offset and the size of the background box
+    """
+    font = load_font(font_name, font_size)
+    bbox = font.getbbox(text)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+    box_size = (int(text_width * 1.1), int(text_height * 1.5))
+
+    # Text is centered horizontally in the background box. Keep the fractional part of its position,
+    # so the glyphs are rasterized exactly as if drawn on the full image.
+    text_x = (box_size[0] - text_width) / 2
+    left = math.floor(text_x + bbox[0]) - 1
+    top = min(0, math.floor(bbox[1]) - 1)
+    width = math.ceil(text_x + bbox[2]) + 1 - left
+    height = math.ceil(bbox[3]) + 1 - top
+
+    text_img = Image.new(MODE, (width, height), (0, 0, 0, 0))
+    ImageDraw.Draw(text_img, MODE).text((text_x - left, -top), text, WHITE, font=font)
+
+    return TextTile(text_img, (left, top), box_size)
+
+
+def _base_copy(img: Image.Image, *, keep_rgb: bool, inplace: bool = False) -> Image.Image:
+    """
+    Return a copy of the image that can be modified in place, RGB images stay RGB if keep_rgb is set.
+
+    RGB images with a transparent color are converted to RGBA, so that color is treated as transparent.
+    If inplace is set, the image itself is returned when no conversion is needed.
+    """
+    if img.mode == MODE or (keep_rgb and img.mode == 'RGB' and 'transparency' not in img.info):
+        return img if inplace else img.copy()
+    return img.convert(MODE)
+
+
+def set_background(img: Image.Image, threads: int = 1) -> Image.Image:
     """
     Convert RGBA image to RGB with black background.
 
     Args:
         img: PIL Image object in RGBA mode
+        threads: Number of threads that flatten horizontal bands of the image
 
     Returns:
         PIL Image object in RGB mode
     """
     rgb_img = Image.new('RGB', img.size, BLACK)
-    rgb_img.paste(img, mask=img.split()[3])  # Use alpha channel as mask
+
+    def flatten(top: int, bottom: int) -> None:
+        # The alpha channel is used as mask without copying it, bands are cropped because paste takes the mask
+        # from the same area as the pasted image.
+        band = img if bottom - top == img.height else img.crop((0, top, img.width, bottom))
+        rgb_img.paste(band, (0, top), band)
+
+    _run_bands(flatten, 0, img.height, threads)
     return rgb_img
+
+
+def _run_bands(func: Callable[[int, int], None], top: int, bottom: int, threads: int) -> None:
+    """
+    Call func(band_top, band_bottom) for horizontal bands of BAND_HEIGHT rows that cover top to bottom.
+
+    With more than one thread the bands are processed concurrently. This only pays off for operations that
+    Pillow runs without holding the GIL, e.g., crop, paste, point and convert. At most threads bands are
+    processed at once, so temporary copies of bands stay small.
+    """
+    if threads <= 1 or bottom - top <= BAND_HEIGHT:
+        func(top, bottom)
+        return
+
+    with ThreadPoolExecutor(threads, 'wim-band') as executor:
+        list(executor.map(lambda y: func(y, min(y + BAND_HEIGHT, bottom)), range(top, bottom, BAND_HEIGHT)))
+
+
+def thumbnail_size(size: tuple[int, int], max_size: tuple[int, int]) -> tuple[int, int]:
+    """
+    Return the size Image.thumbnail scales an image of the given size to, without loading the image.
+
+    Args:
+        size: Width and height of the image
+        max_size: Maximum width and height as passed to Image.thumbnail
+
+    Returns:
+        tuple: Width and height after scaling, size if the image already fits
+    """
+    width, height = size
+    x, y = map(math.floor, max_size)
+    if x >= width and y >= height:
+        return size
+
+    # Same rounding as Image.thumbnail, the side that is not limited is rounded to keep the aspect ratio.
+    aspect = width / height
+    if x / y >= aspect:
+        x = max(min(math.floor(y * aspect), math.ceil(y * aspect), key=lambda n: abs(aspect - n / y)), 1)
+    else:
+        y = max(
+            min(math.floor(x / aspect), math.ceil(x / aspect), key=lambda n: 0 if n == 0 else abs(aspect - x / n)),
+            1,
+        )
+    return x, y
+
+
+class Pipeline:
+    """
+    Processing steps compiled once from typed options and applied to many images.
+
+    The options are validated, the text is rendered and the watermark is prepared when the pipeline is created.
+    The wim command processes its images with a pipeline, so the steps and their order are the same: EXIF
+    orientation, trim, scale, text, watermark and per output format quantization or a black background for
+    formats without alpha channel. The steps are also available one by one as prepare, finish and convert, e.g.,
+    to create several sizes or formats from one decode. A pipeline isn't modified after it was created, so one
+    instance can process images in several threads at once.
+
+    Args:
+        img_format: Output format as file extension, e.g., 'webp', None to keep the format of each input
+        scale: Maximum width and height
+        text: Text added at the bottom right
+        font: Font name or path to .ttf file, None for the default font
+        font_size: Font size in pixels, requires font
+        watermark: Path to or image of the watermark
+        watermark_position: One of POSITIONS
+        watermark_scale: Maximum width and height of the watermark
+        watermark_opacity: Opacity of the watermark 0-255
+        quality: Output quality 1-100 for JPEG and WebP, optimized encoding for PNG and GIF
+        effort: Encoder effort preset, one of EFFORTS
+        max_bytes: Maximum size of encoded images, see encode_max_bytes
+        quantize: Number of colors for PNG and GIF output
+        palette: Shared palette images are mapped to instead of quantizing each, requires quantize
+        quantize_method: Quantization method, one of QUANTIZE_METHODS, None for Pillow's default
+        dither: Dithering applied when mapping to the palette, one of DITHERS
+        strip: Don't copy metadata to encoded images
+        trim: Trim uniform-color borders
+        threads: Number of threads used for horizontal bands of each image, see set_background
+
+    Raises:
+        ValueError: If an option is invalid
+    """
+
+    def __init__(
+        self,
+        img_format: str | None = None,
+        *,
+        scale: tuple[int, int] | None = None,
+        text: str | None = None,
+        font: str | None = None,
+        font_size: int | None = None,
+        watermark: str | Image.Image | None = None,
+        watermark_position: str = 'bottom-right',
+        watermark_scale: tuple[int, int] | None = None,
+        watermark_opacity: int = FULL_OPACITY,
+        quality: int | None = None,
+        effort: str | None = None,
+        max_bytes: int | None = None,
+        quantize: int | None = None,
+        palette: Image.Image | None = None,
+        quantize_method: str | None = None,
+        dither: str = 'none',
+        strip: bool = False,
+        trim: bool = False,
+        threads: int = 1,
+    ):
+        if img_format is not None and img_format not in IMAGE_FORMATS:
+            msg = f'invalid format: {img_format!r} (choose from {", ".join(sorted(IMAGE_FORMATS))})'
+            raise ValueError(msg)
+        if font_size and not font:
+            msg = 'font_size requires font'
+            raise ValueError(msg)
+        if watermark_position not in POSITIONS:
+            msg = f'invalid watermark position: {watermark_position!r} (choose from {", ".join(POSITIONS)})'
+            raise ValueError(msg)
+        if not 0 <= watermark_opacity <= FULL_OPACITY:
+            msg = f'watermark opacity must be between 0 and {FULL_OPACITY}'
+            raise ValueError(msg)
+        if quality is not None and not 1 <= quality <= MAX_QUALITY:
+            msg = f'quality must be between 1 and {MAX_QUALITY}'
+            raise ValueError(msg)
+        if effort is not None and effort not in EFFORTS:
+            msg = f'invalid effort: {effort!r} (choose from {", ".join(EFFORTS)})'
+            raise ValueError(msg)
+        if max_bytes is not None and max_bytes < 1:
+            msg = 'max_bytes must be at least 1'
+            raise ValueError(msg)
+        if quantize is not None and not 1 <= quantize <= MAX_COLORS:
+            msg = f'quantize must be between 1 and {MAX_COLORS}'
+            raise ValueError(msg)
+        if (palette is not None or quantize_method) and not quantize:
+            msg = 'palette and quantize_method require quantize'
+            raise ValueError(msg)
+        if quantize_method is not None and quantize_method not in QUANTIZE_METHODS:
+            msg = f'invalid quantize method: {quantize_method!r} (choose from {", ".join(QUANTIZE_METHODS)})'
+            raise ValueError(msg)
+        if dither not in DITHERS:
+            msg = f'invalid dither: {dither!r} (choose from {", ".join(DITHERS)})'
+            raise ValueError(msg)
+        if threads < 1:
+            msg = 'threads must be at least 1'
+            raise ValueError(msg)
+
+        self.img_format = img_format
+        self.scale: tuple[int, int] | None = (scale[0], scale[1]) if scale else None
+        self.watermark_position = watermark_position
+        self.quality = quality
+        self.effort = effort
+        self.max_bytes = max_bytes
+        self.quantize = quantize
+        self.palette = palette
+        self.quantize_method = QUANTIZE_METHODS.get(quantize_method) if quantize_method else None
+        self.dither = DITHERS[dither]
+        self.strip = strip
+        self.trim = trim
+        self.threads = threads
+
+        self._tile = render_text(font, font_size, text) if text else None  # type: ignore[arg-type]
+        self._overlay = None
+        if isinstance(watermark, Image.Image):
+            # Converting copies the image, so the caller's image isn't modified.
+            self._overlay = _prepare_overlay_image(
+                watermark.convert(MODE), watermark_scale, watermark_opacity, threads=threads
+            )
+        elif watermark:
+            self._overlay = prepare_overlay(watermark, watermark_scale, watermark_opacity, threads=threads)
+
+    def process(self, img: Image.Image) -> Image.Image:
+        """
+        Apply the processing steps to an image and return the result, img is not modified.
+
+        Use process_bytes to decode images that are scaled down at a reduced size, which is much faster.
+
+        Raises:
+            ValueError: If no output format was set and the format of img is unknown
+        """
+        return self._process(img, self._output_format(img), inplace=False)[0]
+
+    def process_bytes(self, data: bytes) -> bytes:
+        """
+        Decode an image file, apply the processing steps and return the encoded output file.
+
+        Animated GIF and WebP images written as GIF or WebP keep all frames, see wim.animation.
+
+        Raises:
+            ValueError: If no output format was set and the format of the input is unknown
+        """
+        from wim.animation import ANIMATED_FORMATS, Animation, is_animated  # noqa: PLC0415
+
+        source = Image.open(io.BytesIO(data))
+        img_format = self._output_format(source)
+
+        result: Image.Image
+        if is_animated(source) and img_format in ANIMATED_FORMATS:
+            colors = self.quantize if img_format in QUANTIZE_FORMATS else None
+            animation = Animation(
+                data,
+                partial(self.process_frame, img_format=img_format),
+                colors,
+                self.palette,
+                self.quantize_method,
+                self.dither,
+            )
+            # The metadata is read from the source, the animation only keeps transparency and duration.
+            save_kwargs = {
+                **({} if self.strip else get_metadata(source)),
+                **animation.save_options(),
+                **self.save_options(img_format),
+            }
+            result = animation
+        else:
+            if self.scale and not self.trim:
+                draft(source, self.scale)
+            source.load()
+            result, save_kwargs = self._process(source, img_format, inplace=True, encoding=True)
+
+        return self.encode(result, img_format, save_kwargs)
+
+    def process_many(
+        self, items: Iterable[bytes | Image.Image], jobs: int | None = None
+    ) -> Iterator[bytes | Image.Image]:
+        """
+        Process images in a thread pool and yield the results in input order.
+
+        Image files given as bytes are passed to process_bytes, images to process. At most two items per
+        thread are processed or waiting to be consumed, so items can be a lazy stream of any length. An
+        exception raised for an item is raised when its result is reached.
+
+        Args:
+            items: Image file contents or images
+            jobs: Number of threads, the number of CPUs by default
+        """
+        jobs = jobs or os.cpu_count() or 1
+
+        def run(item: bytes | Image.Image) -> bytes | Image.Image:
+            return self.process(item) if isinstance(item, Image.Image) else self.process_bytes(item)
+
+        with ThreadPoolExecutor(jobs, 'wim-pipeline') as executor:
+            futures: deque[Future] = deque()
+            for item in items:
+                futures.append(executor.submit(run, item))
+                if len(futures) >= jobs * 2:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+    def prepare(self, img: Image.Image, *, inplace: bool = False) -> tuple[Image.Image, dict]:
+        """
+        Apply the steps that come before scaling and return the image with its metadata as save options.
+
+        The image is transposed according to its EXIF orientation and trimmed. If inplace is set, img must be
+        loaded and is transposed in place, which frees the original frame. Otherwise the result is a copy.
+        """
+        with profiling.stage('exif_transpose'):
+            if inplace:
+                ImageOps.exif_transpose(img, in_place=True)
+            else:
+                img = ImageOps.exif_transpose(img)
+
+        # Extract metadata before further image processing.
+        save_kwargs = {} if self.strip else get_metadata(img)
+
+        if self.trim:
+            with profiling.stage('trim'):
+                img = ImageOps.crop(img)
+        return img, save_kwargs
+
+    def finish(
+        self, img: Image.Image, formats: Sequence[str], *, inplace: bool = False, encoding: bool = False
+    ) -> Image.Image:
+        """
+        Apply the steps that come after scaling for the output formats, modify img itself if inplace is set.
+
+        Text and watermark are blended into RGB images directly if no format keeps the alpha channel. With a
+        single format, the format steps are applied too, see convert for encoding. With several formats, call
+        convert for the result.
+        """
+        img = self._add_overlays(img, formats, inplace=inplace)
+        if len(formats) == 1:
+            img = self.convert(img, formats, encoding=encoding)[0]
+        return img
+
+    def convert(self, img: Image.Image, formats: Iterable[str], *, encoding: bool = False) -> list[Image.Image]:
+        """
+        Apply the format steps to a finished image and return one image per format.
+
+        Images are quantized or mapped to the palette for QUANTIZE_FORMATS and RGBA images get a black
+        background for formats without alpha channel. The background is only applied once and shared by all
+        formats that need it. img is returned for formats that need no conversion.
+
+        Set encoding if the images are passed to encode. With max_bytes, quantization is then left to encode,
+        which searches the number of colors that fits. Images mapped to the palette keep its colors.
+        """
+        flattened = None
+        results = []
+        for img_format in formats:
+            out = img
+            if self.quantize and img_format in QUANTIZE_FORMATS:
+                if not encoding or not self._search_colors(img_format):
+                    with profiling.stage('quantize'):
+                        out = quantize(img, self.quantize, self.palette, self.quantize_method, self.dither)
+            elif img.mode == MODE and img_format not in RGBA_FORMATS:
+                if flattened is None:
+                    with profiling.stage('set_background'):
+                        flattened = set_background(img, self.threads)
+                out = flattened
+            results.append(out)
+        return results
+
+    def process_frame(self, frame: Image.Image, img_format: str, scale: tuple[int, int] | None = None) -> Image.Image:
+        """
+        Scale a frame of an animation and add text and watermark, the frame is modified in place.
+
+        The frame is scaled to scale or the scale of the pipeline. Frames aren't quantized, they are mapped to the palette of the animation, see wim.animation. Animated
+        formats keep the alpha channel, so frames need no background.
+        """
+        scale = scale or self.scale
+        if scale:
+            with profiling.stage('thumbnail'):
+                frame.thumbnail(scale)
+        return self._add_overlays(frame, [img_format], inplace=True)
+
+    def encode(self, img: Image.Image, img_format: str, save_kwargs: dict) -> bytes:
+        """
+        Encode a processed image with the effort preset, within max_bytes if set, see encode_max_bytes.
+
+        For images converted with encoding set, the number of colors is searched up to quantize.
+        """
+        if self.max_bytes:
+            colors = self.quantize if self._search_colors(img_format) else None
+            return encode_max_bytes(
+                img,
+                img_format,
+                self.max_bytes,
+                save_kwargs,
+                effort=self.effort,
+                colors=colors,
+                method=self.quantize_method,
+            )
+        return encode(img, img_format, self.effort, **save_kwargs)
+
+    def save_options(self, img_format: str) -> dict:
+        """Return the quality and effort options passed to Image.save for a format, see get_quality and get_effort."""
+
+        return {
+            **(get_quality(self.quality, img_format) if self.quality else {}),
+            **(get_effort(self.effort, img_format) if self.effort else {}),
+        }
+
+    def _add_overlays(self, img: Image.Image, formats: Iterable[str], *, inplace: bool) -> Image.Image:
+        # Blend overlays into RGB images directly if no output keeps the alpha channel.
+        keep_rgb = not RGBA_FORMATS.intersection(formats)
+        if self._tile:
+            with profiling.stage('add_text'):
+                img = _add_text_tile(img, self._tile, keep_rgb=keep_rgb, inplace=inplace, threads=self.threads)
+        if self._overlay:
+            with profiling.stage('add_image'):
+                img = add_image(
+                    img,
+                    self._overlay,
+                    position=self.watermark_position,
+                    keep_rgb=keep_rgb,
+                    inplace=inplace,
+                    threads=self.threads,
+                )
+        return img
+
+    def _search_colors(self, img_format: str) -> bool:
+        # The number of colors of a shared palette is fixed.
+        return bool(self.max_bytes and self.quantize and self.palette is None and img_format in QUANTIZE_FORMATS)
+
+    def _output_format(self, img: Image.Image) -> str:
+        img_format = self.img_format or (img.format or '').lower()
+        if img_format not in IMAGE_FORMATS:
+            msg = f'cannot infer output format from {img.format} input, set img_format'
+            raise ValueError(msg)
+        return img_format
+
+    def _process(
+        self, img: Image.Image, img_format: str, *, inplace: bool, encoding: bool = False
+    ) -> tuple[Image.Image, dict]:
+        """Apply the processing steps and return the image with its save options, modify img if inplace."""
+
+        img, save_kwargs = self.prepare(img, inplace=inplace)
+        if self.scale:
+            with profiling.stage('thumbnail'):
+                img.thumbnail(self.scale)
+        # The prepared image is a copy or belongs to the caller, overlays are blended into it without copying.
+        img = self.finish(img, [img_format], inplace=True, encoding=encoding)
+        return img, {**save_kwargs, **self.save_options(img_format)}
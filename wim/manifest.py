@@ -0,0 +1,126 @@
+"""
+This module provides the build manifest used by incremental runs to skip inputs that haven't changed.
+
+The manifest is a JSON file that maps each output path to the size and modification time of its source
+file, a fingerprint of the effective options, the wim version used to create it and the files written.
+When multiple sizes are created from one source, the output path without the size suffix is the key.
+
+Functions:
+    - file_hash: Return the SHA-256 hex digest of a file's content.
+    - get_entry: Create the manifest entry for a source file.
+    - get_fingerprint: Create a fingerprint of the options that affect the output images.
+    - is_current: Check whether an output is up to date according to the manifest.
+    - load_manifest: Load a manifest from a JSON file.
+    - save_manifest: Save a manifest to a JSON file.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from wim.__about__ import __version__
+
+# Options that affect the content of output images. The output label and directory are part of the output path.
+FINGERPRINT_OPTIONS = (
+    'dither',
+    'effort',
+    'font',
+    'font_size',
+    'format',
+    'formats',
+    'max_bytes',
+    'quality',
+    'quantize',
+    'quantize_method',
+    'scale',
+    'sizes',
+    'srcset',
+    'strip',
+    'text',
+    'trim',
+    'watermark_opacity',
+    'watermark_position',
+    'watermark_scale',
+)
+
+
+def file_hash(path: str | Path) -> str:
+    """Return the SHA-256 hex digest of a file's content."""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_entry(src: Path, fingerprint: str) -> dict:
+    """
+    Create the manifest entry for a source file.
+
+    Args:
+        src: Path of the source image
+        fingerprint: Fingerprint of the effective options, see get_fingerprint
+
+    Returns:
+        dict: Manifest entry
+    """
+    stat = src.stat()
+    return {
+        'source': str(src),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'options': fingerprint,
+        'version': __version__,
+    }
+
+
+def get_fingerprint(argv: argparse.Namespace) -> str:
+    """
+    Create a fingerprint of the options that affect the output images.
+
+    The watermark is identified by the hash of its content, so changing the watermark file invalidates all
+    outputs that use it. A shared palette is identified by its colors, call this after cli.set_palette.
+
+    Args:
+        argv: Parsed command line arguments
+
+    Returns:
+        str: SHA-256 hex digest of the options
+    """
+    options = {name: getattr(argv, name, None) for name in FINGERPRINT_OPTIONS}
+    options['watermark'] = file_hash(argv.watermark) if argv.watermark else None
+    palette = getattr(argv, 'palette_image', None)
+    options['palette'] = [palette.getpalette(), palette.info.get('transparency')] if palette else None
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def is_current(manifest: dict, dst: Path, entry: dict) -> bool:
+    """Check whether the outputs exist and were created from the same source and options."""
+
+    stored = manifest.get(str(dst))
+    if not stored:
+        return False
+    outputs = stored.get('outputs', [str(dst)])
+    stored = {key: value for key, value in stored.items() if key != 'outputs'}
+    return stored == entry and all(Path(output).exists() for output in outputs)
+
+
+def load_manifest(path: str | Path) -> dict:
+    """Load a manifest from a JSON file, return an empty manifest if the file does not exist."""
+
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(path: str | Path, manifest: dict) -> None:
+    """Save a manifest to a JSON file, replacing the previous file atomically."""
+
+    tmp = Path(f'{path}.tmp')
+    tmp.write_text(json.dumps(manifest, indent=2, sort_keys=True), encoding='utf-8')
+    os.replace(tmp, path)
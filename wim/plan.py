@@ -0,0 +1,293 @@
+"""
+This module plans a batch without processing it, for the --dry-run option.
+
+Only image headers are read, Image.open parses them lazily without decoding pixels. For each file the output
+paths, sizes and processing steps are derived from the options, and the runtime is projected from the number
+of pixels each step handles and the throughput of the step in megapixels per second. The default throughput
+was measured with bin/benchmark.py on a 1920x1080 RGB image, results of a benchmark run written with --output
+can be loaded to calibrate the projection for another machine.
+
+Classes:
+    - Plan: Plan of a single file.
+
+Functions:
+    - format_file: Format the plan of a file as a text line.
+    - format_totals: Format the totals of a batch as text.
+    - load_throughput: Load throughput numbers from benchmark results.
+    - plan_file: Plan the processing of a single file.
+    - run: Plan a batch, print the plan of each file and return the totals.
+
+Constants:
+    - THROUGHPUT: Default throughput of the processing steps in megapixels per second.
+    - CHUNK_SIZE: Number of files planned per task with multiple jobs.
+"""
+
+import argparse
+import itertools
+import json
+import statistics
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import TypedDict
+
+from PIL import Image, UnidentifiedImageError
+
+from wim import cli
+from wim.image import QUANTIZE_FORMATS, RGBA_FORMATS, TRANSPOSED_ORIENTATIONS, draft, get_orientation, thumbnail_size
+
+# Megapixels per second, save steps per output format
+THROUGHPUT = {
+    'decode': 98.0,
+    'exif_transpose': 249.0,
+    'trim': 352.0,
+    'quantize': 4.8,
+    'map_palette': 346.0,
+    'thumbnail': 61.7,
+    'add_text': 263.0,
+    'add_image': 229.0,
+    'set_background': 136.0,
+    'save_bmp': 200.0,
+    'save_gif': 1.9,
+    'save_ico': 50.0,
+    'save_jpeg': 47.7,
+    'save_png': 0.3,
+    'save_webp': 2.0,
+}
+# Copying the file content, stripping metadata without decoding
+STRIP_THROUGHPUT = 500.0
+# Number of files planned per task with multiple jobs
+CHUNK_SIZE = 256
+
+
+class Plan(TypedDict):
+    """Plan of a single file, see plan_file."""
+
+    file: str
+    size: tuple[int, int]
+    mode: str
+    format: str | None
+    bytes: int
+    outputs: list[tuple[str, tuple[int, int]]]
+    steps: list[str]
+    memory: int
+    decoded: float
+    written: float
+    time: float
+
+
+# Name, plan and error message of a planned file
+_Result = tuple[str, Plan | None, str | None]
+
+
+def load_throughput(path: str | Path) -> dict[str, float]:
+    """
+    Load throughput numbers from benchmark results written by bin/benchmark.py --output.
+
+    The median over all sizes and modes is used per operation and per save format, save cases with an effort
+    preset and cases run with several threads are ignored. Operations missing in the results keep their
+    default throughput.
+    """
+    results = json.loads(Path(path).read_text(encoding='utf-8'))['results']
+    measured: dict[str, list[float]] = {}
+    for result in results.values():
+        single = result.get('effort', 'none') == 'none' and result.get('threads', 1) == 1
+        if not single or not result.get('megapixels_per_second'):
+            continue
+        key = f'save_{result["format"]}' if result['op'] == 'save' else result['op']
+        if key in THROUGHPUT:
+            measured.setdefault(key, []).append(result['megapixels_per_second'])
+    return {**THROUGHPUT, **{key: statistics.median(values) for key, values in measured.items()}}
+
+
+def _save_format(img_format: str) -> str:
+    return 'jpeg' if img_format in ('jpg', 'jpe', 'jfif') else img_format
+
+
+def plan_file(name: str, argv: argparse.Namespace, throughput: dict[str, float] = THROUGHPUT) -> Plan:
+    """
+    Plan the processing of a single file from its header.
+
+    Args:
+        name: Input file name
+        argv: Parsed command line arguments
+        throughput: Throughput of the processing steps in megapixels per second
+
+    Returns:
+        Plan: Source size, mode and format, file size, outputs with path and size, applied steps, estimated
+            peak memory in bytes, decoded and written pixels and the projected time in seconds
+    """
+    src = Path(name)
+    argv = argparse.Namespace(**vars(argv))
+    cli.set_pixel_limit(argv)
+    try:
+        img = Image.open(src)
+    except UnidentifiedImageError:
+        msg = f'cannot identify image file {name!r}'
+        raise UnidentifiedImageError(msg) from None
+
+    with img:
+        dst = cli.get_dst(src, argv, mkdir=False)
+        formats = argv.formats or [argv.format or (img.format or '').lower()]
+        src_size, src_mode, src_format, src_bytes = img.size, img.mode, img.format, src.stat().st_size
+        steps: list[tuple[str, float]] = []
+
+        if cli.is_strip_only(argv) and Image.registered_extensions().get(dst.suffix.lower()) == img.format:
+            megapixels = img.width * img.height / 1e6
+            steps.append(('strip', src_bytes / 1e6 / STRIP_THROUGHPUT))
+            outputs = [(dst, img.size)]
+            memory, decoded, written = src_bytes, 0.0, megapixels
+        else:
+            scale = cli.get_scale(img, argv)
+            if scale and not argv.trim:
+                draft(img, scale)
+            memory = cli.estimate_memory(img, argv)
+            decoded = img.width * img.height / 1e6
+            steps.append(('decode', decoded / throughput['decode']))
+
+            size = img.size
+            if get_orientation(img) != 1:
+                steps.append(('exif_transpose', decoded / throughput['exif_transpose']))
+                if get_orientation(img) in TRANSPOSED_ORIENTATIONS:
+                    size = size[::-1]
+            if argv.trim:
+                steps.append(('trim', decoded / throughput['trim']))
+            # Images are mapped to a shared palette instead of building a palette each.
+            quantize = 'map_palette' if argv.palette or argv.palette_sample else 'quantize'
+            if argv.quantize and not argv.formats and argv.format not in QUANTIZE_FORMATS:
+                steps.append((f'quantize skipped for {argv.format}', 0.0))
+
+            sizes: list[tuple[int, int]] = []
+            for max_size in cli.sort_sizes(size, argv.sizes) if argv.sizes else [argv.scale]:
+                previous, size = size, thumbnail_size(size, max_size) if max_size else size
+                if size != previous:
+                    steps.append(('thumbnail', previous[0] * previous[1] / 1e6 / throughput['thumbnail']))
+                if not sizes or size != previous:
+                    sizes.append(size)
+
+            # Overlays keep RGB images in RGB mode if no output keeps the alpha channel, see finish_image.
+            converted = img.mode != 'RGB' or bool(RGBA_FORMATS.intersection(formats))
+            flatten = 'A' in img.getbands() or (bool(argv.text or argv.watermark) and converted)
+
+            outputs = []
+            written = 0.0
+            for width, height in sizes:
+                megapixels = width * height / 1e6
+                suffix = f'-{width}w' if argv.sizes else ''
+                steps.extend(
+                    (step, megapixels / throughput[step])
+                    for step, option in (('add_text', argv.text), ('add_image', argv.watermark))
+                    if option
+                )
+                for img_format in formats:
+                    path_argv = argparse.Namespace(**{**vars(argv), 'format': img_format}) if argv.formats else argv
+                    outputs.append((cli.get_dst(src, path_argv, suffix, mkdir=False), (width, height)))
+                    if argv.quantize and img_format in QUANTIZE_FORMATS:
+                        steps.append((quantize, megapixels / throughput[quantize]))
+                    if flatten and img_format not in RGBA_FORMATS:
+                        steps.append(('set_background', megapixels / throughput['set_background']))
+                    save_format = _save_format(img_format)
+                    steps.append((f'save {save_format}', megapixels / throughput.get(f'save_{save_format}', 1.0)))
+                    written += megapixels
+
+    # The same step is listed once with the time of all its runs.
+    step_times: dict[str, float] = {}
+    for step, seconds in steps:
+        step_times[step] = step_times.get(step, 0.0) + seconds
+
+    return {
+        'file': name,
+        'size': src_size,
+        'mode': src_mode,
+        'format': src_format,
+        'bytes': src_bytes,
+        'outputs': [(str(path), size) for path, size in outputs],
+        'steps': list(step_times),
+        'memory': memory,
+        'decoded': decoded,
+        'written': written,
+        'time': sum(step_times.values()),
+    }
+
+
+def format_file(plan: Plan) -> str:
+    """Format the plan of a file as a text line."""
+
+    width, height = plan['size']
+    outputs = ', '.join(f'{path} {size[0]}x{size[1]}' for path, size in plan['outputs'])
+    return (
+        f'{plan["file"]}: {width}x{height} {plan["mode"]} {plan["format"]} {plan["bytes"] / 2**20:.1f}MB '
+        f'-> {outputs}; steps: {", ".join(plan["steps"])}; memory ~{plan["memory"] / 2**20:.0f}MB, '
+        f'~{plan["time"]:.2f}s'
+    )
+
+
+def format_totals(totals: dict) -> str:
+    """Format the totals of a batch as text."""
+
+    return (
+        f'Dry run: {totals["files"]} files, {totals["failed"]} unreadable, '
+        f'{totals["decoded"]:.1f} megapixels decoded, {totals["written"]:.1f} megapixels written, '
+        f'peak memory per image ~{totals["memory"] / 2**20:.0f}MB, '
+        f'projected runtime ~{totals["time"]:.1f}s with --jobs {totals["jobs"]}.'
+    )
+
+
+def _plan_or_error(name: str, argv: argparse.Namespace, throughput: dict[str, float]) -> _Result:
+    try:
+        return name, plan_file(name, argv, throughput), None
+    except Exception as e:  # noqa: BLE001
+        return name, None, f'{type(e).__name__}: {e}'
+
+
+def _plan_files(names: list[str], argv: argparse.Namespace, throughput: dict[str, float]) -> list[_Result]:
+    """Plan files and return the name, plan and error message of each, errors don't stop the batch."""
+
+    return [_plan_or_error(name, argv, throughput) for name in names]
+
+
+def _chunks(names: Iterable[str]) -> Iterator[list[str]]:
+    names = iter(names)
+    while chunk := list(itertools.islice(names, CHUNK_SIZE)):
+        yield chunk
+
+
+def run(names: Iterable[str], argv: argparse.Namespace, jobs: int, throughput: dict[str, float] = THROUGHPUT) -> dict:
+    """
+    Plan a batch, print the plan of each file in input order and return the totals.
+
+    With more than one job, headers are read by worker processes in chunks of CHUNK_SIZE files, at most two
+    chunks per worker ahead of the output. The projected runtime assumes that the work is spread evenly over
+    the jobs.
+    """
+    totals = {'files': 0, 'failed': 0, 'decoded': 0.0, 'written': 0.0, 'memory': 0, 'time': 0.0, 'jobs': jobs}
+
+    def report(results: list[_Result]) -> None:
+        for name, plan, error in results:
+            totals['files'] += 1
+            if plan is None:
+                totals['failed'] += 1
+                print(f'{name}: {error}')
+                continue
+            print(format_file(plan))
+            totals['decoded'] += plan['decoded']
+            totals['written'] += plan['written']
+            totals['memory'] = max(totals['memory'], plan['memory'])
+            totals['time'] += plan['time']
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures: deque[Future] = deque()
+            for chunk in _chunks(names):
+                futures.append(executor.submit(_plan_files, chunk, argv, throughput))
+                if len(futures) >= jobs * 2:
+                    report(futures.popleft().result())
+            while futures:
+                report(futures.popleft().result())
+    else:
+        for chunk in _chunks(names):
+            report(_plan_files(chunk, argv, throughput))
+
+    totals['time'] /= jobs
+    return totals
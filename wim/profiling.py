@@ -0,0 +1,205 @@
+"""
+This module provides per-stage profiling of image processing.
+
+Profiling is disabled by default, then stage returns a shared no-op context manager, so instrumented code
+runs at practically full speed. When enabled, every stage records its wall time, the CPU time of the
+calling thread and how much the stage raised the peak RSS of the process, together with the file being
+processed. The peak RSS only grows, so a stage that stays within memory used before records no growth; run
+the stage on its own, e.g., with bin/benchmark.py, to measure its total memory use.
+
+Example:
+    from wim import profiling
+
+    profiling.enable()
+    with profiling.file('photo.jpg'), profiling.stage('custom'):
+        ...
+    print(profiling.format_table(profiling.summarize(profiling.drain())))
+
+Functions:
+    - add_records: Add records collected elsewhere, e.g., in worker processes.
+    - disable: Disable profiling.
+    - drain: Return and remove all collected records.
+    - enable: Enable profiling.
+    - file: Set the file that subsequent stages are recorded for.
+    - format_table: Format summary rows as a text table.
+    - is_enabled: Check whether profiling is enabled.
+    - percentile: Return a percentile of a list of values.
+    - stage: Context manager that records a processing stage.
+    - summarize: Aggregate records per stage.
+    - write_trace: Write records to a JSON or CSV file.
+"""
+
+import contextvars
+import csv
+import json
+import math
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None  # type: ignore
+
+FIELDS = ('file', 'stage', 'wall', 'cpu', 'rss_growth')
+
+_records: list[dict] | None = None
+_file: contextvars.ContextVar[str | None] = contextvars.ContextVar('file', default=None)
+_null = nullcontext()
+
+
+def _max_rss() -> int | None:
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class _Stage:
+    __slots__ = ('cpu', 'name', 'rss', 'wall')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        self.rss = _max_rss()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        rss = _max_rss()
+        growth = None if rss is None or self.rss is None else rss - self.rss
+        if _records is not None:
+            _records.append({'file': _file.get(), 'stage': self.name, 'wall': wall, 'cpu': cpu, 'rss_growth': growth})
+
+
+def add_records(records: list[dict]) -> None:
+    """Add records collected elsewhere, e.g., in worker processes."""
+
+    if _records is not None:
+        _records.extend(records)
+
+
+def disable() -> None:
+    """Disable profiling and discard collected records."""
+
+    global _records  # noqa: PLW0603
+    _records = None
+
+
+def drain() -> list[dict]:
+    """Return and remove all collected records."""
+
+    if _records is None:
+        return []
+    records = _records[:]
+    del _records[: len(records)]
+    return records
+
+
+def enable() -> None:
+    """Enable profiling, records collected before are kept."""
+
+    global _records  # noqa: PLW0603
+    if _records is None:
+        _records = []
+
+
+@contextmanager
+def file(name: str):
+    """Set the file that stages inside this context are recorded for."""
+
+    token = _file.set(str(name))
+    try:
+        yield
+    finally:
+        _file.reset(token)
+
+
+def format_table(rows: list[dict]) -> str:
+    """Format summary rows returned by summarize as a text table with times in milliseconds."""
+
+    lines = [f'{"stage":<16} {"count":>6} {"total":>10} {"cpu":>10} {"p50":>9} {"p95":>9} {"rss +":>9}']
+    for row in rows:
+        rss = 'n/a' if row['rss_growth'] is None else f'{row["rss_growth"] / 2**20:.0f}MB'
+        lines.append(
+            f'{row["stage"]:<16} {row["count"]:>6} {row["wall"] * 1000:>8.1f}ms {row["cpu"] * 1000:>8.1f}ms '
+            f'{row["p50"] * 1000:>7.1f}ms {row["p95"] * 1000:>7.1f}ms {rss:>9}'
+        )
+    return '\n'.join(lines)
+
+
+def is_enabled() -> bool:
+    """Check whether profiling is enabled."""
+
+    return _records is not None
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Return the p-th percentile of values using the nearest-rank method."""
+
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def stage(name: str):
+    """
+    Return a context manager that records the time spent in a processing stage.
+
+    Args:
+        name: Name of the stage, e.g., 'decode' or 'save'
+
+    Returns:
+        Context manager, a shared no-op context manager if profiling is disabled
+    """
+    return _null if _records is None else _Stage(name)
+
+
+def summarize(records: list[dict]) -> list[dict]:
+    """
+    Aggregate records per stage, in the order stages first appear.
+
+    Args:
+        records: Records returned by drain
+
+    Returns:
+        list: One dict per stage with count, total wall and CPU time, p50 and p95 wall time and the
+            largest peak RSS growth
+    """
+    stages: dict[str, list[dict]] = {}
+    for record in records:
+        stages.setdefault(record['stage'], []).append(record)
+
+    rows = []
+    for name, items in stages.items():
+        wall = [item['wall'] for item in items]
+        rss = [item['rss_growth'] for item in items if item['rss_growth'] is not None]
+        rows.append(
+            {
+                'stage': name,
+                'count': len(items),
+                'wall': sum(wall),
+                'cpu': sum(item['cpu'] for item in items),
+                'p50': percentile(wall, 50),
+                'p95': percentile(wall, 95),
+                'rss_growth': max(rss) if rss else None,
+            }
+        )
+    return rows
+
+
+def write_trace(path: str | Path, records: list[dict]) -> None:
+    """Write records to a CSV file if path ends with .csv, otherwise to a JSON file."""
+
+    if str(path).lower().endswith('.csv'):
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        Path(path).write_text(json.dumps(records, indent=2), encoding='utf-8')
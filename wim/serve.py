@@ -0,0 +1,193 @@
+"""
+This module provides a long-running server that processes jobs without per-invocation startup cost.
+
+Jobs are JSON objects, one per line, read from stdin or a Unix socket. Each job has an optional "id" and
+"args", a list of command line arguments as accepted by wim, e.g.:
+
+    {"id": 1, "args": ["photo.jpg", "-s", "800", "800", "-w", "logo.png"]}
+
+Files are processed by a pool of worker processes that stay alive between jobs, so fonts, text tiles and
+watermarks loaded for one job are reused by the next. For each job one JSON line is written, in the order
+jobs finish:
+
+    {"id": 1, "ok": true, "time": 0.012, "files": [{"file": "photo.jpg", "outputs": [...], "time": 0.011}]}
+
+Functions:
+    - get_args: Parse the command line arguments of the serve command.
+    - handle_job: Parse a job and submit its files to the worker pool.
+    - main: Run the server.
+    - serve_stream: Process jobs read from a stream and write results to another stream.
+
+Constants:
+    - UNSUPPORTED_OPTIONS: wim options that jobs can't use.
+"""
+
+import argparse
+import io
+import json
+import os
+import signal
+import socketserver
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+from wim import cli
+
+UNSUPPORTED_OPTIONS = ('stdout', 'incremental', 'profile', 'profile_output', 'dry_run')
+
+
+def get_args(args=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='wim serve', description='Process wim jobs read as JSON lines.')
+    parser.add_argument('--socket', help='Path of a Unix socket to listen on instead of reading jobs from stdin.')
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of worker processes (default: number of CPU cores).',
+    )
+    argv = parser.parse_args(args)
+
+    if argv.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    return argv
+
+
+def run_file(name, argv: argparse.Namespace) -> dict:
+    """Process a single file in a worker process and return its result."""
+
+    start = time.perf_counter()
+    (_, dsts, output, error), _ = cli.run_job(name, argv)
+    return {
+        'file': name,
+        'outputs': [str(dst) for dst in dsts or []],
+        'output': output,
+        'error': error,
+        'time': time.perf_counter() - start,
+    }
+
+
+def _error(job_id, message: str, start: float) -> dict:
+    return {'id': job_id, 'ok': False, 'error': message, 'time': time.perf_counter() - start}
+
+
+def handle_job(line: str, executor: Executor) -> tuple[object, dict | None, list[Future], float]:
+    """
+    Parse a job and submit its files to the worker pool.
+
+    Args:
+        line: JSON object with an optional id and a list of command line arguments in args
+        executor: Worker pool the files are submitted to
+
+    Returns:
+        tuple: Job id, error response or None, futures of the submitted files and start time of the job
+    """
+    start = time.perf_counter()
+    job_id = None
+    try:
+        job = json.loads(line)
+        job_id = job.get('id')
+        args = job['args']
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return job_id, _error(job_id, f'invalid job: {e}', start), [], start
+
+    try:
+        return _submit(job_id, args, executor, start)
+    except Exception as e:  # noqa: BLE001
+        # An unexpected error of one job must not stop the server and the jobs after it.
+        return job_id, _error(job_id, f'{type(e).__name__}: {e}', start), [], start
+
+
+def _submit(job_id, args: list, executor: Executor, start: float) -> tuple[object, dict | None, list[Future], float]:
+    """Parse the command line arguments of a job and submit its files, see handle_job."""
+
+    try:
+        # argparse prints help and version to stdout, which is the response stream when reading from stdin.
+        with redirect_stdout(sys.stderr):
+            argv = cli.get_args([str(arg) for arg in args])
+    except SystemExit as e:
+        message = 'invalid arguments' if e.code else '--help and --version are not supported by wim serve'
+        return job_id, _error(job_id, message, start), [], start
+
+    # Outputs on stdout, profiles, manifests and plans belong to a single wim run.
+    for option in UNSUPPORTED_OPTIONS:
+        if getattr(argv, option):
+            message = f'--{option.replace("_", "-")} is not supported by wim serve'
+            return job_id, _error(job_id, message, start), [], start
+
+    if argv.files_from == cli.STDIN:
+        return job_id, _error(job_id, '--files-from - is not supported by wim serve', start), [], start
+
+    try:
+        names = cli.set_palette(argv, cli.iter_inputs(argv))
+    except OSError as e:
+        return job_id, _error(job_id, f'cannot load palette: {e}', start), [], start
+    except ValueError as e:
+        return job_id, _error(job_id, f'cannot build palette: {e}', start), [], start
+
+    return job_id, None, [executor.submit(run_file, name, argv) for name in names], start
+
+
+def serve_stream(rfile, wfile, executor: Executor) -> None:
+    """
+    Process jobs read from a text stream and write one JSON line per job to another text stream.
+
+    Jobs run concurrently, results are written as soon as all files of a job are processed.
+    """
+    lock = threading.Lock()
+
+    def respond(response: dict) -> None:
+        with lock:
+            wfile.write(json.dumps(response) + '\n')
+            wfile.flush()
+
+    def finish(job_id, futures: list[Future], start: float) -> None:
+        files = [future.result() for future in futures]
+        ok = not any(result['error'] for result in files)
+        respond({'id': job_id, 'ok': ok, 'time': time.perf_counter() - start, 'files': files})
+
+    with ThreadPoolExecutor(thread_name_prefix='wim-respond') as responder:
+        for line in rfile:
+            if not line.strip():
+                continue
+            job_id, error, futures, start = handle_job(line, executor)
+            if error:
+                respond(error)
+            else:
+                responder.submit(finish, job_id, futures, start)
+
+
+def main(args=None) -> None:
+    argv = get_args(args)
+
+    with ProcessPoolExecutor(max_workers=argv.jobs) as executor:
+        if not argv.socket:
+            serve_stream(sys.stdin, sys.stdout, executor)
+            return
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                rfile = io.TextIOWrapper(self.rfile, encoding='utf-8')
+                wfile = io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True)
+                serve_stream(rfile, wfile, executor)
+
+        # Remove a socket left behind by a server that was killed.
+        if os.path.exists(argv.socket) and stat.S_ISSOCK(os.stat(argv.socket).st_mode):
+            os.unlink(argv.socket)
+
+        # Exit cleanly on SIGTERM, so the socket is removed.
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+        with socketserver.ThreadingUnixStreamServer(argv.socket, Handler) as server:
+            print(f'Listening on {argv.socket}', file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.unlink(argv.socket)
@@ -0,0 +1,179 @@
+"""
+This module removes metadata from JPEG and PNG files without decoding and re-encoding the image data.
+
+The container is rewritten segment by segment (JPEG) or chunk by chunk (PNG), the compressed image data is
+copied unchanged. This is lossless and runs at the speed of copying bytes instead of the speed of the codec.
+
+Metadata that changes how the image is displayed is not removed silently: if the EXIF orientation rotates or
+flips the image, stripping is refused, because the pixels would have to be transposed first.
+
+Functions:
+    - strip_jpeg: Remove APPn segments other than JFIF and Adobe as well as comments from a JPEG file.
+    - strip_metadata: Remove metadata from a JPEG or PNG file.
+    - strip_png: Remove text, EXIF, ICC profile and time chunks from a PNG file.
+
+Constants:
+    - JPEG_KEEP_SEGMENTS: APPn markers and identifiers of JPEG segments that are needed to decode the image.
+    - PNG_METADATA_CHUNKS: Types of PNG chunks that are removed.
+"""
+
+from PIL import Image
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+JPEG_MARKER = 0xFF
+JPEG_APP0 = 0xE0
+JPEG_APP1 = 0xE1
+JPEG_APP14 = 0xEE
+# APP0-APP15 and RST0-RST7 markers
+JPEG_APPN = range(0xE0, 0xF0)
+JPEG_RST = range(0xD0, 0xD8)
+JPEG_SOS = 0xDA
+JPEG_COM = 0xFE
+# Markers without a length field: TEM and RST0-RST7
+JPEG_STANDALONE = {0x01, *JPEG_RST}
+# JFIF defines the pixel density and the Adobe segment the color transform of CMYK and YCbCr images.
+JPEG_KEEP_SEGMENTS = {(JPEG_APP0, b'JFIF\x00'), (JPEG_APP0, b'JFXX\x00'), (JPEG_APP14, b'Adobe')}
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_METADATA_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'eXIf', b'iCCP', b'tIME'}
+PNG_TEXT_CHUNKS = {b'tEXt', b'zTXt', b'iTXt'}
+EXIF_ORIENTATION = 0x0112
+
+
+def _keeps_orientation(exif: bytes) -> bool:
+    """Check whether removing EXIF data leaves the image displayed as before."""
+
+    try:
+        orientation = Image.Exif()
+        orientation.load(exif)
+        return orientation.get(EXIF_ORIENTATION, 1) == 1
+    except Exception:  # noqa: BLE001
+        # Unreadable EXIF data may still be honored by other readers, keep the image unchanged.
+        return False
+
+
+def _scan_end(data: bytes, pos: int) -> int:
+    """Return the position of the first marker after entropy-coded data starting at pos."""
+
+    while True:
+        pos = data.index(b'\xff', pos)
+        following = data[pos + 1]
+        # 0xFF 0x00 is an escaped 0xFF byte and restart markers are part of the scan.
+        if following == 0 or following in JPEG_RST:
+            pos += 2
+        else:
+            return pos
+
+
+def strip_jpeg(data: bytes) -> bytes | None:
+    """
+    Remove APPn segments other than JFIF and Adobe as well as comments from a JPEG file.
+
+    Args:
+        data: Content of a JPEG file
+
+    Returns:
+        bytes: JPEG file without metadata, None if the data can't be parsed or the EXIF orientation isn't 1
+    """
+    if not data.startswith(JPEG_SOI):
+        return None
+
+    parts = [JPEG_SOI]
+    pos = len(JPEG_SOI)
+    try:
+        while True:
+            if data[pos] != JPEG_MARKER:
+                return None
+            # Markers may be preceded by any number of 0xFF fill bytes.
+            while data[pos + 1] == JPEG_MARKER:
+                pos += 1
+            marker = data[pos + 1]
+
+            if marker == JPEG_EOI[1]:
+                # Data after the end of the image, e.g., MPF preview images, belongs to removed metadata.
+                parts.append(JPEG_EOI)
+                return b''.join(parts)
+
+            if marker in JPEG_STANDALONE:
+                parts.append(data[pos : pos + 2])
+                pos += 2
+                continue
+
+            end = pos + 2 + int.from_bytes(data[pos + 2 : pos + 4], 'big')
+            segment = data[pos:end]
+            if len(segment) != end - pos:
+                return None
+
+            if marker in JPEG_APPN or marker == JPEG_COM:
+                if marker == JPEG_APP1 and segment[4:10] == b'Exif\x00\x00' and not _keeps_orientation(segment[4:]):
+                    return None
+                if any(marker == keep and segment[4:].startswith(ident) for keep, ident in JPEG_KEEP_SEGMENTS):
+                    parts.append(segment)
+            else:
+                parts.append(segment)
+            pos = end
+
+            if marker == JPEG_SOS:
+                scan_end = _scan_end(data, pos)
+                parts.append(data[pos:scan_end])
+                pos = scan_end
+    except (IndexError, ValueError):
+        # Truncated file, let the decoder deal with it.
+        return None
+
+
+def strip_png(data: bytes) -> bytes | None:
+    """
+    Remove text, EXIF, ICC profile and time chunks from a PNG file.
+
+    Args:
+        data: Content of a PNG file
+
+    Returns:
+        bytes: PNG file without metadata, None if the data can't be parsed or the EXIF orientation isn't 1
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return None
+
+    parts = [PNG_SIGNATURE]
+    pos = len(PNG_SIGNATURE)
+    while pos < len(data):
+        # Length, type, data and CRC
+        end = pos + 12 + int.from_bytes(data[pos : pos + 4], 'big')
+        chunk_type = data[pos + 4 : pos + 8]
+        chunk = data[pos:end]
+        if len(chunk) != end - pos:
+            return None
+
+        if chunk_type == b'eXIf' and not _keeps_orientation(chunk[8:-4]):
+            return None
+        # Pillow also reads EXIF data from the text chunk ImageMagick writes.
+        if chunk_type in PNG_TEXT_CHUNKS and chunk[8:].startswith(b'Raw profile type exif\x00'):
+            return None
+        if chunk_type not in PNG_METADATA_CHUNKS:
+            parts.append(chunk)
+        pos = end
+
+        if chunk_type == b'IEND':
+            return b''.join(parts)
+
+    return None
+
+
+def strip_metadata(data: bytes, img_format: str | None) -> bytes | None:
+    """
+    Remove metadata from a JPEG or PNG file without decoding the image data.
+
+    Args:
+        data: Content of the image file
+        img_format: Format of the image as detected by Pillow, e.g., 'JPEG' or 'PNG', None if unknown
+
+    Returns:
+        bytes: Image file without metadata, None if the format isn't supported or metadata can't be removed
+        without changing the image
+    """
+    if img_format == 'JPEG':
+        return strip_jpeg(data)
+    if img_format == 'PNG':
+        return strip_png(data)
+    return None